@@ -0,0 +1,96 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from startup import lazy_module
+
+np = lazy_module("numpy")
+
+
+class SemanticAnswerCache:
+    # Answers keyed on the question embedding, a lookup hits when the cosine
+    # similarity to a cached question is at least `threshold`
+
+    def __init__(self, threshold=0.95, max_entries=1000, ttl=24 * 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._ids = itertools.count()
+        self._version = None
+        self._lock = threading.Lock()
+        self._keys = []
+        self._matrix = None
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+
+    def _expire(self):
+        deadline = time.monotonic() - self.ttl
+        expired = [key for key, (_, _, created) in self._entries.items() if created < deadline]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, embedding, version):
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_version(version)
+            self._expire()
+            if self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries)
+                    self._matrix = np.stack([self._entries[key][0] for key in self._keys])
+                scores = self._matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    key = self._keys[best]
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][1]
+            self.misses += 1
+            return None
+
+    def store(self, embedding, payload, version):
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._check_version(version)
+            self._entries[next(self._ids)] = (vector, payload, time.monotonic())
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+                "threshold": self.threshold,
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+            }
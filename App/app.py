@@ -1,27 +1,54 @@
+import time
+_import_started = time.perf_counter()
+
 import os
+import re
+import hmac
+import json
+import functools
+import threading
 import uuid
+import base64
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
-import openai
 import boto3
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
-from gtts import gTTS
+import click
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, stream_with_context, send_file, abort, g
 from boto3.dynamodb.conditions import Key, Attr
-from llama_index.core import VectorStoreIndex, ServiceContext
-from llama_index.core.prompts.base import ChatPromptTemplate
-from llama_index.llms.openai import OpenAI
-from llama_index.core import SimpleDirectoryReader
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-import fitz
-import base64
-import stripe
+from botocore.exceptions import BotoCoreError, ClientError
+import startup
+import telemetry
+import batch_qa
+import conversation_store
+import http_clients
+import process_memory
+import quota
+import webhooks
+from user_cache import UserCache
+from write_buffer import WriteBehindBuffer
+from answer_cache import SemanticAnswerCache
+from chat_engines import ChatEnginePool
+from job_scheduler import JobScheduler, QueueFull
+
+# Heavy ML, PDF and payment dependencies are imported on first use
+stripe = startup.lazy_module("stripe")
+index_store = startup.lazy_module("index_store")
+page_store = startup.lazy_module("page_store")
+page_index = startup.lazy_module("page_index")
+tts_cache = startup.lazy_module("tts_cache")
+
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
 
+telemetry.configure_logging()
+log = telemetry.get_logger("app")
+
 
 # Initialize DynamoDB
 dynamodb = boto3.resource('dynamodb', region_name='ap-southeast-2')
 dynamodb_client = boto3.client('dynamodb', region_name='ap-southeast-2')
+telemetry.instrument_boto_client(dynamodb.meta.client)
+telemetry.instrument_boto_client(dynamodb_client)
 
 # Create tables if they don't exist
 def create_dynamodb_table(table_name, key_schema, attribute_definitions, provisioned_throughput, global_secondary_indexes=None):
@@ -37,229 +64,512 @@ def create_dynamodb_table(table_name, key_schema, attribute_definitions, provisi
 
         table = dynamodb.create_table(**table_params)
         table.meta.client.get_waiter('table_exists').wait(TableName=table_name)
-        print(f"Table {table_name} created successfully.")
+        log.info("Table created", extra={"fields": {"table": table_name}})
     except dynamodb_client.exceptions.ResourceInUseException:
-        print(f"Table {table_name} already exists.")
-
-create_dynamodb_table(
-    'Users',
-    key_schema=[
-        {'AttributeName': 'id', 'KeyType': 'HASH'}
-    ],
-    attribute_definitions=[
-        {'AttributeName': 'id', 'AttributeType': 'S'},
-        {'AttributeName': 'email', 'AttributeType': 'S'}
-    ],
-    provisioned_throughput={
-        'ReadCapacityUnits': 10,
-        'WriteCapacityUnits': 10
-    },
-    global_secondary_indexes=[
-        {
-            'IndexName': 'email-index',
-            'KeySchema': [
-                {'AttributeName': 'email', 'KeyType': 'HASH'}
-            ],
-            'Projection': {
-                'ProjectionType': 'ALL'
-            },
-            'ProvisionedThroughput': {
-                'ReadCapacityUnits': 10,
-                'WriteCapacityUnits': 10
+        log.info("Table already exists", extra={"fields": {"table": table_name}})
+
+TABLE_NAMES = ('Users', 'ChatHistory', 'Feedback')
+
+# One-off provisioning, run with `flask --app app init-db`
+def setup_tables():
+    create_dynamodb_table(
+        'Users',
+        key_schema=[
+            {'AttributeName': 'id', 'KeyType': 'HASH'}
+        ],
+        attribute_definitions=[
+            {'AttributeName': 'id', 'AttributeType': 'S'},
+            {'AttributeName': 'email', 'AttributeType': 'S'}
+        ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 10,
+            'WriteCapacityUnits': 10
+        },
+        global_secondary_indexes=[
+            {
+                'IndexName': 'email-index',
+                'KeySchema': [
+                    {'AttributeName': 'email', 'KeyType': 'HASH'}
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL'
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 10,
+                    'WriteCapacityUnits': 10
+                }
             }
+        ]
+    )
+
+    create_dynamodb_table(
+        'ChatHistory',
+        key_schema=[
+            {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+        ],
+        attribute_definitions=[
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+        ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 10,
+            'WriteCapacityUnits': 10
         }
-    ]
-)
+    )
 
-create_dynamodb_table(
-    'ChatHistory',
-    key_schema=[
-        {'AttributeName': 'user_id', 'KeyType': 'HASH'},
-        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
-    ],
-    attribute_definitions=[
-        {'AttributeName': 'user_id', 'AttributeType': 'S'},
-        {'AttributeName': 'timestamp', 'AttributeType': 'S'}
-    ],
-    provisioned_throughput={
-        'ReadCapacityUnits': 10,
-        'WriteCapacityUnits': 10
-    }
-)
+    create_dynamodb_table(
+        'Feedback',
+        key_schema=[
+            {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+        ],
+        attribute_definitions=[
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'}
+        ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 10,
+            'WriteCapacityUnits': 10
+        }
+    )
 
-create_dynamodb_table(
-    'Feedback',
-    key_schema=[
-        {'AttributeName': 'user_id', 'KeyType': 'HASH'},
-        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
-    ],
-    attribute_definitions=[
-        {'AttributeName': 'user_id', 'AttributeType': 'S'},
-        {'AttributeName': 'timestamp', 'AttributeType': 'S'}
-    ],
-    provisioned_throughput={
-        'ReadCapacityUnits': 10,
-        'WriteCapacityUnits': 10
-    }
-)
+_ready_tables = set()
+_table_checks = {}  # table name -> (checked at, result) of the last check that wasn't ACTIVE
+_table_locks = {table_name: threading.Lock() for table_name in TABLE_NAMES}
+TABLE_RECHECK_INTERVAL = 30
+
+def table_ready(table_name):
+    # Cached describe_table check; only ready tables are cached for good,
+    # other results for TABLE_RECHECK_INTERVAL. One check per table at a time,
+    # the requests arriving meanwhile wait for it.
+    if table_name in _ready_tables:
+        return True
+    with _table_locks[table_name]:
+        if table_name in _ready_tables:
+            return True
+        checked_at, ready = _table_checks.get(table_name, (float('-inf'), False))
+        if time.monotonic() - checked_at < TABLE_RECHECK_INTERVAL:
+            return ready
+
+        try:
+            status = dynamodb_client.describe_table(TableName=table_name)['Table']['TableStatus']
+        except dynamodb_client.exceptions.ResourceNotFoundException:
+            status = None
+        except (BotoCoreError, ClientError) as e:
+            # Throttling, permissions or the network: whether the table exists
+            # is unknown, so don't turn requests away until the next check
+            log.warning("Could not check table", extra={"fields": {"table": table_name, "error": str(e)}})
+            _table_checks[table_name] = (time.monotonic(), True)
+            return True
+        if status in ('ACTIVE', 'UPDATING'):
+            _ready_tables.add(table_name)
+            return True
+        _table_checks[table_name] = (time.monotonic(), False)
+    log.warning("Table is not ready, run `flask --app app init-db`", extra={"fields": {"table": table_name, "status": status}})
+    return False
 
 users_table = dynamodb.Table('Users')
+user_cache = UserCache(
+    users_table,
+    ttl=float(os.getenv("USER_CACHE_TTL", 30)),
+    max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000)),
+)
 chat_history_table = dynamodb.Table('ChatHistory')
 feedback_table = dynamodb.Table('Feedback')
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-messages = []
-
-def appendMessage(role, message, type='message'):
-    messages.append({"role": role, "content": message, "type": type})
+# Chat history and feedback are written behind the request, in batches
+write_buffer = WriteBehindBuffer(
+    {'ChatHistory': ['user_id', 'timestamp'], 'Feedback': ['user_id', 'timestamp']},
+    flush_interval=float(os.getenv("WRITE_BUFFER_FLUSH_INTERVAL", 1.0)),
+    max_pending=int(os.getenv("WRITE_BUFFER_MAX_PENDING", 10000)),
+    drain_timeout=float(os.getenv("WRITE_BUFFER_DRAIN_TIMEOUT", 30)),
+    enabled=os.getenv("WRITE_BEHIND", "1") == "1",
+)
 
+conversations = conversation_store.create_store()
 
-pdf_dir="./data"
+def appendMessage(user_id, role, message, type='message'):
+    conversations.append(user_id, role, message, type)
 
 def load_data():
-    reader = SimpleDirectoryReader(pdf_dir, recursive=True)
-    docs = reader.load_data()
-    
-    llm = OpenAI(model="gpt-3.5-turbo", temperature="0.1", systemprompt="""Use the books in data file as source for the answer. Generate a valid 
-                 and relevant answer to a query related to 
-                 construction problems, ensure the answer is based strictly on the content of 
-                 the book and not influenced by other sources. Do not hallucinate. The answer should 
-                 be informative and fact-based. """)
-    service_content = ServiceContext.from_defaults(llm=llm)
-    index = VectorStoreIndex.from_documents(docs, service_context=service_content)
-    return index
+    return index_store.get_index()
+
+_warm_up_started = False
+_warm_up_lock = threading.Lock()
+
+def warm_up():
+    # Load (or build and persist) the document and page indexes
+    load_data()
+    page_index.get_page_index()
+    startup.print_report()
+
+def start_warm_up():
+    # Runs once per process, in the background so requests are served meanwhile
+    global _warm_up_started
+    with _warm_up_lock:
+        if _warm_up_started or os.getenv("WARM_START", "1") != "1":
+            return
+        _warm_up_started = True
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+def preload():
+    # For pre-fork servers: load everything in the master before it forks, so
+    # the workers share it instead of each loading a copy (see gunicorn.conf.py)
+    global _warm_up_started
+    with _warm_up_lock:
+        _warm_up_started = True
+    warm_up()
+
+def missing_tables():
+    return [table_name for table_name in TABLE_NAMES if not table_ready(table_name)]
+
+@app.before_request
+def begin_trace():
+    g.trace = telemetry.begin(request.headers.get("X-Request-ID"))
+
+@app.after_request
+def add_trace_header(response):
+    g.status = response.status_code
+    response.headers["X-Request-ID"] = g.trace.trace_id
+    return response
+
+@app.teardown_request
+def end_trace(error=None):
+    # Streamed responses are torn down once the stream ends, so their
+    # timings cover the whole body
+    trace = g.pop('trace', None)
+    if trace is not None:
+        status = 500 if error is not None else g.get('status', 500)
+        telemetry.finish_request(trace, request.method, request.endpoint or "unmatched", status)
+    telemetry.end()
+
+@app.before_request
+def prepare_request():
+    start_warm_up()
+    webhook_worker.ensure_started()
+    if request.endpoint in (None, 'static', 'privacy', 'terms', 'metrics'):
+        return None
+    missing = missing_tables()
+    if missing:
+        return jsonify({"error": f"Service is not ready, missing tables: {', '.join(missing)}"}), 503
+    return None
 
 def query_chatbot(query_engine, user_question):
     response = query_engine.query(user_question)
     return response.response if response else None
 
-def initialize_chatbot(pdf_dir = "./data", model="gpt-3.5-turbo", temperature=0.4):
-    documents = SimpleDirectoryReader(pdf_dir).load_data()
-    llm = OpenAI(model=model, temperature=temperature)
-
-    additional_questions_prompt_str = (
-        "Given the context below, generate only one additional question different from previous additional questions related to the user's query:\n"
-        "Context:\n"
-        "User Query: {query_str}\n"
-        "Chatbot Response: \n"
-    )
+FOLLOWUP_QUESTION_COUNT = int(os.getenv("FOLLOWUP_QUESTION_COUNT", 3))
+_followup_engines = {}
+_followup_engines_lock = threading.Lock()
+
+def initialize_chatbot(num_questions=FOLLOWUP_QUESTION_COUNT, model="gpt-3.5-turbo", temperature=0.4):
+    # One follow-up engine per question count, built once over the shared index
+    query_engine = _followup_engines.get(num_questions)
+    if query_engine is not None:
+        return query_engine
+
+    from llama_index.core.prompts.base import ChatPromptTemplate
+    from llama_index.llms.openai import OpenAI
+
+    with _followup_engines_lock:
+        if num_questions in _followup_engines:
+            return _followup_engines[num_questions]
+
+        llm = OpenAI(model=model, temperature=temperature, callback_manager=index_store.callback_manager(), **http_clients.openai_kwargs())
+
+        additional_questions_prompt_str = (
+            "Context information is below.\n"
+            "---------------------\n"
+            "{context_str}\n"
+            "---------------------\n"
+            "Chatbot Response: {query_str}\n"
+            f"Given the context and the chatbot response, generate {num_questions} different additional questions "
+            "related to the user's query. Answer only with a JSON array of strings.\n"
+        )
 
-    new_context_prompt_str = (
-        "We have the opportunity to only one generate additional question different from previous additional questions based on new context.\n"
-        "New Context:\n"
-        "User Query: {query_str}\n"
-        "Chatbot Response: \n"
-        "Given the new context, generate only one additional questions different at each time from previous additional questions related to the user's query."
-        "If the context isn't useful, generate only one additional questions different at each from previous time from previous additional questions based on the original context.\n"
-    )
+        new_context_prompt_str = (
+            "We have the opportunity to refine the additional questions based on new context.\n"
+            "Existing questions: {existing_answer}\n"
+            "New Context:\n"
+            "{context_msg}\n"
+            "Chatbot Response: {query_str}\n"
+            f"Given the new context, return {num_questions} different additional questions related to the user's query. "
+            "If the context isn't useful, return the existing questions. Answer only with a JSON array of strings.\n"
+        )
 
-    chat_text_qa_msgs = [
-        (
-            "system",
-            """Generate only one additional question that facilitates deeper exploration of the main topic 
-            discussed in the user's query and the chatbot's response. The question should be relevant and
-              insightful, encouraging further discussion and exploration of the topic. Keep the question concise 
-              and focused on different aspects of the main topic to provide a comprehensive understanding.""",
-        ),
-        ("user", additional_questions_prompt_str),
-    ]
-    text_qa_template = ChatPromptTemplate.from_messages(chat_text_qa_msgs)
-
-    chat_refine_msgs = [
-        (
-            "system",
-            """Based on the user's question '{prompt}' and the chatbot's response '{response}', please 
-            generate only one additional question related to the main topic. The question should be 
-            insightful and encourage further exploration of the main topic, providing a more comprehensive 
-            understanding of the subject matter.""",
-        ),
-        ("user", new_context_prompt_str),
-    ]
-    refine_template = ChatPromptTemplate.from_messages(chat_refine_msgs)
-    index = VectorStoreIndex.from_documents(documents)
-    query_engine = index.as_query_engine(
-        text_qa_template=text_qa_template,
-        refine_template=refine_template,
-        llm=llm,
-    )
+        chat_text_qa_msgs = [
+            (
+                "system",
+                f"""Generate {num_questions} additional questions that facilitate deeper exploration of the main topic
+                discussed in the user's query and the chatbot's response. Each question should be relevant and
+                insightful, encouraging further discussion and exploration of the topic. Keep the questions concise,
+                never repeat a question, and focus each one on a different aspect of the main topic.""",
+            ),
+            ("user", additional_questions_prompt_str),
+        ]
+        text_qa_template = ChatPromptTemplate.from_messages(chat_text_qa_msgs)
+
+        chat_refine_msgs = [
+            (
+                "system",
+                f"""Refine the list of {num_questions} additional questions related to the main topic. The questions
+                should be insightful and encourage further exploration of the main topic, providing a more
+                comprehensive understanding of the subject matter.""",
+            ),
+            ("user", new_context_prompt_str),
+        ]
+        refine_template = ChatPromptTemplate.from_messages(chat_refine_msgs)
+
+        query_engine = load_data().as_query_engine(
+            text_qa_template=text_qa_template,
+            refine_template=refine_template,
+            llm=llm,
+            callback_manager=index_store.callback_manager(),
+            similarity_top_k=2,
+            response_mode="compact",
+        )
+        _followup_engines[num_questions] = query_engine
 
     return query_engine
 
-def generate_response(user_question):
-    index = load_data()
-    chat_engine = index.as_chat_engine(chat_mode="condense_question", verbose=True)
+chat_engines = ChatEnginePool(
+    load_data,
+    lambda: index_store.index_version(),
+    lambda: index_store.callback_manager(),
+    max_engines=int(os.getenv("CHAT_ENGINE_POOL_SIZE", 200)),
+    idle_ttl=int(os.getenv("CHAT_ENGINE_IDLE_TTL", 1800)),
+    memory_token_limit=int(os.getenv("CHAT_MEMORY_TOKEN_LIMIT", 1500)),
+)
+
+AUDIO_MAX_AGE = int(os.getenv("AUDIO_MAX_AGE", 7 * 24 * 3600))
+
+def audio_url_for(key):
+    return url_for('audio', key=key) if key else None
+
+def audio_url_builder():
+    # audio_url_for() for use off the request thread, bound to this request's URL adapter
+    url_adapter = app.create_url_adapter(request)
+    return lambda key: url_adapter.build('audio', {'key': key}) if key else None
+
+def generate_audio(response_text, lang='en'):
+    # Audio is synthesised lazily by the /audio route when playback is requested
+    return audio_url_for(tts_cache.register(response_text, lang))
+
+# Post-answer stages are independent of each other and share one bounded pool
+stage_executor = ThreadPoolExecutor(max_workers=int(os.getenv("STAGE_WORKERS", 8)), thread_name_prefix="stage")
 
-    response = chat_engine.chat(user_question)
+POST_ANSWER_STAGES = {
+    "audio": lambda response_text: tts_cache.register(response_text),
+    "additional_questions": lambda response_text: generate_additional_questions(response_text),
+}
+
+STAGE_TIMEOUTS = {
+    "audio": float(os.getenv("AUDIO_STAGE_TIMEOUT", 5)),
+    "additional_questions": float(os.getenv("FOLLOWUP_STAGE_TIMEOUT", 20)),
+}
+
+def run_stage(stage, fn, response_text):
+    with telemetry.stage(stage):
+        return fn(response_text)
+
+def iter_post_answer_stages(response_text):
+    # Yields (stage, result) as each stage finishes; a stage that fails or
+    # runs past its timeout yields None instead of failing the request
+    started = time.monotonic()
+    futures = {
+        telemetry.run_in_context(stage_executor, run_stage, stage, fn, response_text): stage
+        for stage, fn in POST_ANSWER_STAGES.items()
+    }
+    pending = set(futures)
+    while pending:
+        deadline = min(started + STAGE_TIMEOUTS[futures[future]] for future in pending)
+        done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        for future in done:
+            stage = futures[future]
+            try:
+                yield stage, future.result()
+            except Exception:
+                telemetry.stage_failed(stage, "error")
+                log.warning("Stage failed", exc_info=True, extra={"fields": {"stage": stage}})
+                yield stage, None
+
+        now = time.monotonic()
+        for future in list(pending):
+            stage = futures[future]
+            if now >= started + STAGE_TIMEOUTS[stage]:
+                future.cancel()
+                pending.discard(future)
+                telemetry.stage_failed(stage, "timeout")
+                log.warning("Stage timed out", extra={"fields": {"stage": stage, "timeout": STAGE_TIMEOUTS[stage]}})
+                yield stage, None
+
+def run_post_answer_stages(response_text):
+    return dict(iter_post_answer_stages(response_text))
+
+answer_cache = SemanticAnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+    max_entries=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000)),
+    ttl=int(os.getenv("ANSWER_CACHE_TTL", 24 * 3600)),
+)
+
+def lookup_cached_answer(user_question, user_id=None):
+    # Returns the question embedding, the index version and the cached
+    # (response_text, additional_questions, document_session, document_sources).
+    # Questions asked mid-conversation depend on the history, so they bypass the cache.
+    version = index_store.index_version()
+    if user_id is not None and chat_engines.has_history(user_id):
+        return None, version, None
+    with telemetry.stage("answer_cache"):
+        question_embedding = index_store.embed_model().get_query_embedding(user_question)
+        return question_embedding, version, answer_cache.lookup(question_embedding, version)
+
+def store_cached_answer(question_embedding, version, answer):
+    # Skip answers generated against an index that has since been refreshed
+    if question_embedding is not None and version == index_store.index_version():
+        answer_cache.store(question_embedding, answer, version)
+
+def generate_response(user_question, user_id=None):
+    question_embedding, version, cached = lookup_cached_answer(user_question, user_id)
+    if cached:
+        response_text, additional_questions, document_session, document_sources = cached
+        if user_id is not None:
+            chat_engines.record_turn(user_id, user_question, response_text)
+        return response_text, additional_questions, generate_audio(response_text), document_session, document_sources
+
+    with chat_engines.session(user_id) as chat_engine, telemetry.stage("chat"):
+        response = chat_engine.chat(user_question)
     if response:
         response_text = response.response
+        document_session, document_sources = document_section_from_nodes(response.source_nodes, response_text)
+
+        stages = run_post_answer_stages(response_text)
+        audio_url = audio_url_for(stages["audio"])
+        additional_questions = stages["additional_questions"]
+
+        if additional_questions is not None:
+            store_cached_answer(question_embedding, version, (response_text, additional_questions, document_session, document_sources))
+        return response_text, additional_questions, audio_url, document_session, document_sources
+
+    return None, None, None, None, None
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 16))
+
+def batch_answer(user_question):
+    # A question answered as /chat would, but without a user: no quota, no
+    # conversation history and nothing recorded. The request context is only
+    # there for url_for in generate_response().
+    with app.test_request_context():
+        response_text, additional_questions, audio_url, document_session, document_sources = generate_response(user_question)
+    return {
+        "answer": response_text,
+        "additional_questions": additional_questions,
+        "sources": [{"pdf": source["pdf"], "page": source["page"], "score": source["score"]} for source in document_sources or []],
+    }
 
-        tts = gTTS(text=response_text, lang='en')
-        tts.save('output.wav')
-
-        with open('output.wav', 'rb') as audio_file:
-            audio_data = base64.b64encode(audio_file.read()).decode('utf-8')
-
-        additional_questions = generate_additional_questions(response_text)
-        document_session = extract_document_section(response_text)
-
-        return response_text, additional_questions, audio_data, document_session
-
-    return None, None, None, None
-
-def generate_additional_questions(user_question):
-    additional_questions = []
-    words = ["1", "2", "3"]
-    for word in words:
-        question = query_chatbot(initialize_chatbot(), user_question)
-        additional_questions.append(question if question else None)
-
-    return additional_questions
-
-def extract_text_from_pdf_page(pdf_path, page_num):
-    doc = fitz.open(pdf_path)
-    page = doc.load_page(page_num)
-    text = page.get_text("text")
-    return text
-
-def extract_document_section(response_text, pdf_dir = "./data"):
-    # Load all PDFs from the directory
-    pdf_texts = {}
-    for filename in os.listdir(pdf_dir):
-        if filename.endswith(".pdf"):
-            pdf_path = os.path.join(pdf_dir, filename)
-            doc = fitz.open(pdf_path)
-            page_count = doc.page_count
-            page_texts = []
-            for i in range(page_count):
-                page_texts.append(extract_text_from_pdf_page(pdf_path, i))
-            pdf_texts[filename] = page_texts
-
-    # Calculate similarity between response text and each paragraph in PDFs
-    response_paragraphs = response_text.split("\n\n")
-    most_similar_page = None
-    max_similarity = 0.0
-    for pdf_name, page_texts in pdf_texts.items():
-        for page_num, page_text in enumerate(page_texts):
-            for response_paragraph in response_paragraphs:
-                corpus = [page_text, response_paragraph]
-                vectorizer = TfidfVectorizer()
-                tfidf_matrix = vectorizer.fit_transform(corpus)
-                similarity = cosine_similarity(tfidf_matrix)[0][1]
-                if similarity > max_similarity:
-                    max_similarity = similarity
-                    most_similar_page = (pdf_name, page_num)
-
-    # Return the text of the most similar page or section
-    if most_similar_page is not None:
-        pdf_name, page_num = most_similar_page
-        return pdf_texts[pdf_name][page_num]
-    else:
-        return "Question is out of documents"
+def parse_question_list(text, limit):
+    # Accept a JSON array, falling back to one question per line
+    try:
+        candidates = json.loads(text[text.index('['):text.rindex(']') + 1])
+    except ValueError:
+        candidates = text.splitlines()
+
+    questions = []
+    seen = set()
+    for candidate in candidates:
+        if not isinstance(candidate, str):
+            continue
+        question = re.sub(r'^\s*(?:[-*\u2022]|\d+[.)])\s*', '', candidate).strip().strip('"').strip()
+        key = re.sub(r'[^a-z0-9]+', ' ', question.lower()).strip()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        questions.append(question)
+        if len(questions) == limit:
+            break
+    return questions
+
+def generate_additional_questions(user_question, num_questions=FOLLOWUP_QUESTION_COUNT):
+    response_text = query_chatbot(initialize_chatbot(num_questions), user_question)
+    if not response_text:
+        return []
+    return parse_question_list(response_text, num_questions)
+
+SOURCE_SECTION_COUNT = int(os.getenv("SOURCE_SECTION_COUNT", 3))
+
+HIGHLIGHT_STOPWORDS = frozenset("""
+about above after again also because been before being below between both could does doing during each
+from further have having here into more most must only other over same should some such than that their
+them then there these they this those through under until very were what when where which while will
+with would your
+""".split())
+
+def highlight_spans(text, response_text, max_spans=20):
+    # Character spans of `text` covering runs of two or more of the answer's
+    # content words; short words and stopwords don't break a run
+    words = {
+        word for word in re.findall(r"[a-z0-9']+", response_text.lower())
+        if len(word) > 3 and word not in HIGHLIGHT_STOPWORDS
+    }
+    spans = []
+    run_start = run_end = None
+    run_words = 0
+    for match in re.finditer(r"[A-Za-z0-9']+", text):
+        word = match.group().lower()
+        if word in words:
+            if run_start is None:
+                run_start, run_words = match.start(), 0
+            run_end = match.end()
+            run_words += 1
+        elif len(word) > 3 and word not in HIGHLIGHT_STOPWORDS:
+            if run_start is not None and run_words >= 2:
+                spans.append([run_start, run_end])
+            run_start = None
+    if run_start is not None and run_words >= 2:
+        spans.append([run_start, run_end])
+    return spans[:max_spans]
+
+def citations_from_nodes(source_nodes, response_text, limit=SOURCE_SECTION_COUNT):
+    # The chunks the chat engine retrieved for this answer, best first
+    ranked = sorted(source_nodes or [], key=lambda node_with_score: node_with_score.score or 0.0, reverse=True)
+    citations = []
+    for node_with_score in ranked[:limit]:
+        text = node_with_score.node.get_content()
+        metadata = node_with_score.node.metadata
+        page = metadata.get("page_label")
+        citations.append({
+            "pdf": metadata.get("file_name"),
+            "page": int(page) if page and page.isdigit() else page,
+            "score": node_with_score.score,
+            "text": text,
+            "highlights": highlight_spans(text, response_text),
+        })
+    return citations
+
+def document_section_from_nodes(source_nodes, response_text, limit=SOURCE_SECTION_COUNT):
+    with telemetry.stage("document_section"):
+        citations = citations_from_nodes(source_nodes, response_text, limit)
+        if not citations:
+            # Nothing was retrieved, fall back to searching the pages
+            return extract_document_section(response_text, limit)
+        return citations[0]["text"], citations
+
+def find_document_sections(response_text, top_k=SOURCE_SECTION_COUNT):
+    return page_index.search(response_text, top_k=top_k)
+
+def extract_document_section(response_text, top_k=SOURCE_SECTION_COUNT):
+    # Text of the most similar page plus the top-k pages with their scores
+    sections = find_document_sections(response_text, top_k)
+    if not sections:
+        return "Question is out of documents", []
+    sources = [{"pdf": s["pdf"], "page": s["page"], "score": s["score"]} for s in sections]
+    return sections[0]["text"], sources
 
 @app.route("/")
 def index():
     if 'username' in session:
-        return render_template("index.html", messages=messages)
+        return render_template("index.html", messages=conversations.messages(session.get('user_id')))
     return redirect(url_for("login"))
 
 @app.route("/register", methods=["GET", "POST"])
@@ -280,18 +590,18 @@ def register():
         user_id = str(uuid.uuid4())
         registration_date = datetime.utcnow().isoformat()
 
-        users_table.put_item(
-            Item={
-                "id": user_id,
-                "username": username,
-                "password": password,
-                "email": email,
-                "registration_date": registration_date,
-                "user_type": user_type,  # Default user type
-                "question_count": 0,
-                "last_question_date": registration_date
-            }
-        )
+        user = {
+            "id": user_id,
+            "username": username,
+            "password": password,
+            "email": email,
+            "registration_date": registration_date,
+            "user_type": user_type,  # Default user type
+            "question_count": 0,
+            "last_question_date": registration_date
+        }
+        users_table.put_item(Item=user)
+        user_cache.put(user)
 
         session["username"] = username
         session["user_id"] = user_id  # Set the user_id in the session
@@ -321,54 +631,370 @@ def login():
     return render_template("login.html")
 
 
+def consume_question(user_id):
+    user_quota = quota.consume_question(users_table, user_id)
+    if user_quota.user:
+        # The updated item comes back with the quota update
+        user_cache.put(user_quota.user)
+    return user_quota
+
+def update_user(user_id, update_expression, values):
+    # Changes only the given attributes, so a cached copy can't overwrite a newer item
+    response = users_table.update_item(
+        Key={'id': user_id},
+        UpdateExpression=update_expression,
+        ConditionExpression=Attr('id').exists(),
+        ExpressionAttributeValues=values,
+        ReturnValues='ALL_NEW'
+    )
+    user_cache.put(response['Attributes'])
+    return response['Attributes']
+
+def record_chat(user_id, user_question, response_text):
+    appendMessage(user_id, 'user', user_question)
+    appendMessage(user_id, 'assistant', response_text, type='response')
+
+    write_buffer.put(chat_history_table, {
+        "user_id": user_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "user_question": user_question,
+        "chatbot_response": response_text
+    })
+
+def record_additional_questions(user_id, additional_questions):
+    if additional_questions:
+        for question in additional_questions:
+            appendMessage(user_id, "user", question)
+            appendMessage(user_id, 'assistant', question, type='additional_question')
+
+# Chat questions run as jobs on a bounded pool of workers, so a burst queues
+# up (or is turned away) instead of fanning out to OpenAI all at once
+job_scheduler = JobScheduler(
+    workers=int(os.getenv("JOB_WORKERS", 8)),
+    max_queued=int(os.getenv("JOB_MAX_QUEUED", 100)),
+    per_user_limit=int(os.getenv("JOB_PER_USER_LIMIT", 2)),
+    max_running_per_user=int(os.getenv("JOB_MAX_RUNNING_PER_USER", 1)),
+    max_priority_wait=float(os.getenv("JOB_MAX_PRIORITY_WAIT", 30)),
+    job_ttl=int(os.getenv("JOB_TTL", 600)),
+)
+JOB_WAIT_TIMEOUT = float(os.getenv("JOB_WAIT_TIMEOUT", 120))
+
+def job_priority(user_id):
+    # Pro users' questions go ahead of everyone else's
+    user = user_cache.get(user_id)
+    return 0 if user and user.get('user_type') == 'pro' else 1
+
+def question_key(user_question):
+    return re.sub(r'\s+', ' ', user_question.strip().lower())
+
+def chat_job(user_question, user_id, build_audio_url, emit):
+    # The answer pipeline as a job: emits the token, answer, document_session,
+    # audio and additional_questions events as they become available and
+    # returns what generate_response() returns. Runs on a scheduler worker,
+    # outside the request, so it must not use Flask's request globals.
+    question_embedding, version, cached = lookup_cached_answer(user_question, user_id)
+    if cached:
+        response_text, additional_questions, document_session, document_sources = cached
+        chat_engines.record_turn(user_id, user_question, response_text)
+        emit("token", {"text": response_text})
+        emit("answer", {"response_text": response_text})
+        audio_url = build_audio_url(tts_cache.register(response_text))
+        emit("audio", {"audio_url": audio_url})
+        emit("document_session", {"document_session": document_session, "document_sources": document_sources})
+        emit("additional_questions", {"additional_questions": additional_questions})
+        return response_text, additional_questions, audio_url, document_session, document_sources
+
+    tokens = []
+    with chat_engines.session(user_id) as chat_engine, telemetry.stage("chat"):
+        started = time.perf_counter()
+        streaming_response = chat_engine.stream_chat(user_question)
+        for token in streaming_response.response_gen:
+            if not tokens:
+                telemetry.observe_stage("first_token", time.perf_counter() - started)
+            tokens.append(token)
+            emit("token", {"text": token})
+
+    response_text = "".join(tokens)
+    if not response_text:
+        return None, None, None, None, None
+    emit("answer", {"response_text": response_text})
+
+    document_session, document_sources = document_section_from_nodes(streaming_response.source_nodes, response_text)
+    emit("document_session", {"document_session": document_session, "document_sources": document_sources})
+
+    audio_url = additional_questions = None
+    for stage, result in iter_post_answer_stages(response_text):
+        if stage == "audio":
+            audio_url = build_audio_url(result)
+            emit("audio", {"audio_url": audio_url})
+        elif stage == "additional_questions":
+            additional_questions = result
+            emit("additional_questions", {"additional_questions": additional_questions})
+
+    if additional_questions is not None:
+        store_cached_answer(question_embedding, version, (response_text, additional_questions, document_session, document_sources))
+    return response_text, additional_questions, audio_url, document_session, document_sources
+
+def finish_chat_job(user_id, user_question, remaining_questions, job, result):
+    # Runs for each job sharing the answer, in the worker once it is complete
+    response_text, additional_questions, audio_url, document_session, document_sources = result
+    if response_text:
+        if job.coalesced:
+            # The answer was generated in another user's chat session
+            chat_engines.record_turn(user_id, user_question, response_text)
+        record_chat(user_id, user_question, response_text)
+        record_additional_questions(user_id, additional_questions)
+    return {"response_text": response_text, "additional_questions": additional_questions, "audio_url": audio_url, "document_session": document_session, "document_sources": document_sources, "remaining_questions": remaining_questions}
+
+def queue_full_response(error):
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+def submit_chat_job(user_id, user_question):
+    # Returns (error response, job). The place in the queue is reserved before
+    # the question is counted, so being turned away doesn't cost a question.
+    # Identical questions in flight share one answer, unless it would depend
+    # on the conversation so far: the user has history, or a job in flight
+    # that will add to it (the scheduler drops the key then).
+    key = None if chat_engines.has_history(user_id) else question_key(user_question)
+    try:
+        job = job_scheduler.reserve(user_id, job_priority(user_id), key)
+    except QueueFull as e:
+        return queue_full_response(e), None
+
+    user_quota = consume_question(user_id)
+    if not user_quota.allowed:
+        job_scheduler.cancel(job)
+        return jsonify({"error": user_quota.error}), None
+
+    job_scheduler.start(
+        job,
+        functools.partial(chat_job, user_question, user_id, audio_url_builder()),
+        on_done=functools.partial(finish_chat_job, user_id, user_question, user_quota.remaining),
+        info={"remaining_questions": user_quota.remaining},
+    )
+    return None, job
+
+def user_job(job_id):
+    job = job_scheduler.get(job_id)
+    if job is None or job.user_id != session['user_id']:
+        abort(404)
+    return job
+
+def job_status_response(job):
+    status = job_scheduler.status(job)
+    status["status_url"] = url_for("chat_job_status", job_id=job.id)
+    status["stream_url"] = url_for("chat_job_stream", job_id=job.id)
+    return jsonify(status), 200 if job.state in ("done", "failed") else 202
+
+def job_event_stream(job):
+    # SSE of a job: its place in the queue while it waits, then the answer as
+    # it is generated, as in /chat/stream
+    def events():
+        yield sse_event("job", {"job_id": job.id})
+        for event, data in job_scheduler.events(job, JOB_WAIT_TIMEOUT):
+            if event == "answer":
+                data = dict(data, **job.info)
+            yield sse_event(event, data)
+        if job.state == "failed":
+            yield sse_event("error", {"error": "Failed to generate a response"})
+        elif job.state != "done":
+            yield sse_event("error", {"error": "Timed out waiting for a response", "job_id": job.id})
+        elif not job.result["response_text"]:
+            yield sse_event("error", {"error": "No response generated"})
+        else:
+            yield sse_event("done", {})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.route("/chat", methods=["POST"])
 def chat():
     if 'username' not in session:
         return jsonify({"error": "User not logged in"})
 
-    user_question = request.json["user_question"]
-    user_id = session['user_id']
+    error, job = submit_chat_job(session['user_id'], request.json["user_question"])
+    if error:
+        return error
+    if not job_scheduler.wait(job, JOB_WAIT_TIMEOUT):
+        # Still queued or running: the answer can be polled with the job id
+        return job_status_response(job)
+    if job.state == "failed":
+        return jsonify({"error": "Failed to generate a response"}), 500
+    return jsonify(job.result)
+
+@app.route("/chat/jobs", methods=["POST"])
+def chat_job_submit():
+    # Like /chat, but returns the job at once; poll status_url or follow stream_url
+    if 'username' not in session:
+        return jsonify({"error": "User not logged in"})
 
-    response = users_table.get_item(Key={'id': user_id})
-    user = response.get('Item')
-    if user:
-        last_question_date = datetime.fromisoformat(user.get('last_question_date', '1970-01-01')).date()
-        current_date = datetime.utcnow().date()
+    error, job = submit_chat_job(session['user_id'], request.json["user_question"])
+    if error:
+        return error
+    return job_status_response(job)
+
+@app.route("/chat/jobs/<job_id>")
+def chat_job_status(job_id):
+    if 'username' not in session:
+        return jsonify({"error": "User not logged in"})
+    return job_status_response(user_job(job_id))
+
+@app.route("/chat/jobs/<job_id>/stream")
+def chat_job_stream(job_id):
+    if 'username' not in session:
+        return jsonify({"error": "User not logged in"})
+    return job_event_stream(user_job(job_id))
 
-        if last_question_date < current_date:
-            user['question_count'] = 0
+@app.route("/chat/reset", methods=["POST"])
+def chat_reset():
+    if 'username' not in session:
+        return jsonify({"error": "User not logged in"})
 
-        question_limit = 10 if user.get('user_type') == 'pro' else 5
+    conversations.clear(session['user_id'])
+    chat_engines.reset(session['user_id'])
+    return jsonify({"message": "Conversation cleared"})
 
-        if user['question_count'] >= question_limit:
-            return jsonify({"error": f"{user['user_type'].capitalize()} user has reached maximum question limit"})
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        user['question_count'] += 1
-        user['last_question_date'] = current_date.isoformat()
-        users_table.put_item(Item=user)
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    # Same as /chat, but answer tokens are sent as they are generated and the
+    # follow-up questions, source section and audio follow as separate events
+    if 'username' not in session:
+        return jsonify({"error": "User not logged in"})
 
-        response_text, additional_questions, audio_data, document_session = generate_response(user_question)
-        appendMessage('user', user_question)
-        appendMessage('assistant', response_text, type='response')
-
-        if additional_questions:
-            for question in additional_questions:
-                appendMessage("user", question)
-                appendMessage('assistant', question, type='additional_question')
-
-        chat_history_table.put_item(
-            Item={
-                "user_id": user_id,
-                "timestamp": datetime.utcnow().isoformat(),
-                "user_question": user_question,
-                "chatbot_response": response_text
-            }
-        )
+    error, job = submit_chat_job(session['user_id'], request.json["user_question"])
+    if error:
+        return error
+    return job_event_stream(job)
+
+@app.route("/audio/<key>.mp3")
+def audio(key):
+    if 'username' not in session:
+        abort(401)
+    if not re.fullmatch(r'[0-9a-f]{64}', key):
+        abort(404)
+
+    # Content-addressed, so the file for a key never changes. Eviction in
+    # another thread or worker may remove it before it is opened, then it is
+    # synthesised again.
+    for _ in range(2):
+        audio_path = tts_cache.get_audio_path(key)
+        if audio_path is None:
+            abort(404)
+        try:
+            response = send_file(audio_path, mimetype="audio/mpeg", conditional=True, etag=key, max_age=AUDIO_MAX_AGE)
+            break
+        except FileNotFoundError:
+            continue
+    else:
+        abort(404)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+
+def admin_required(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admin_token = os.getenv("ADMIN_TOKEN")
+        if not admin_token or not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), admin_token):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route("/metrics")
+def metrics():
+    # Unauthenticated unless METRICS_TOKEN is set, then scrapers send it as a bearer token
+    metrics_token = os.getenv("METRICS_TOKEN")
+    if metrics_token and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {metrics_token}"):
+        abort(403)
+    return Response(telemetry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/admin/webhooks")
+@admin_required
+def webhook_stats():
+    return jsonify(webhook_queue.counts())
+
+@app.route("/admin/write_buffer", methods=["GET", "POST"])
+@admin_required
+def write_buffer_stats():
+    # POST flushes everything pending now
+    if request.method == "POST":
+        write_buffer.flush()
+    return jsonify(write_buffer.stats())
+
+@app.route("/admin/user_cache", methods=["GET", "DELETE"])
+@admin_required
+def user_cache_stats():
+    if request.method == "DELETE":
+        user_cache.clear()
+    return jsonify(user_cache.stats())
+
+@app.route("/admin/startup")
+@admin_required
+def startup_report():
+    return jsonify(startup.report())
+
+@app.route("/admin/memory")
+@admin_required
+def memory_report():
+    # ?workers=1 adds the parent and all its children, i.e. the whole gunicorn tree
+    if request.args.get("workers") == "1":
+        return jsonify(process_memory.tree_report(os.getppid()))
+    return jsonify(process_memory.report())
+
+@app.route("/admin/jobs")
+@admin_required
+def job_stats():
+    return jsonify(job_scheduler.stats())
+
+@app.route("/admin/batch", methods=["POST"])
+@admin_required
+def batch_questions():
+    # Questions as a JSONL body, or as a "questions" file upload with an
+    # optional "completed" file of results from an interrupted run to resume.
+    # Streams one JSON result per line as each question is answered.
+    completed = set()
+    if request.files:
+        if "questions" not in request.files:
+            return jsonify({"error": "No questions file"}), 400
+        lines = request.files["questions"].read().decode().splitlines()
+        if "completed" in request.files:
+            completed = batch_qa.completed_ids(request.files["completed"].read().decode().splitlines())
+    else:
+        lines = request.get_data(as_text=True).splitlines()
+    try:
+        items = list(batch_qa.read_questions(lines))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    concurrency = max(1, min(request.args.get("concurrency", BATCH_CONCURRENCY, type=int), BATCH_MAX_CONCURRENCY))
+
+    def results():
+        for record in batch_qa.run_batch(items, batch_answer, concurrency, completed):
+            yield json.dumps(record) + "\n"
 
-        return jsonify({"response_text": response_text, "additional_questions": additional_questions, "audio_data": audio_data, "document_session": document_session})
+    return Response(stream_with_context(results()), mimetype="application/x-ndjson")
 
-    return jsonify({"error": "User not found"})
+@app.route("/admin/chat_engines")
+@admin_required
+def chat_engine_stats():
+    return jsonify(chat_engines.stats())
 
+@app.route("/admin/answer_cache", methods=["GET", "DELETE"])
+@admin_required
+def answer_cache_stats():
+    if request.method == "DELETE":
+        answer_cache.clear()
+    return jsonify(answer_cache.stats())
 
 
 @app.route("/change_password", methods=["GET", "POST"])
@@ -377,8 +1003,7 @@ def change_password():
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    response = users_table.get_item(Key={'id': user_id})
-    user = response.get('Item')
+    user = user_cache.get(user_id, fresh=request.method == "POST")
 
     if user:
         if request.method == "POST":
@@ -392,8 +1017,7 @@ def change_password():
             if new_password != confirm_password:
                 return render_template("change_password.html", error="Passwords do not match")
 
-            user['password'] = new_password
-            users_table.put_item(Item=user)
+            update_user(user_id, "SET password = :password", {':password': new_password})
 
             return redirect(url_for('account'))
 
@@ -407,8 +1031,7 @@ def account():
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    response = users_table.get_item(Key={'id': user_id})
-    user = response.get('Item')
+    user = user_cache.get(user_id)
 
     if user:
         user_data = {
@@ -427,26 +1050,100 @@ def privacy():
 def terms():
     return render_template("terms.html")
 
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 20))
+HISTORY_MAX_PAGE_SIZE = 100
+
+def encode_history_cursor(last_evaluated_key):
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode('utf-8')).decode('ascii')
+
+def decode_history_cursor(cursor, user_id):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        return None
+    # A cursor can only continue the current user's own history
+    if not isinstance(key, dict) or key.get('user_id') != user_id or set(key) != {'user_id', 'timestamp'}:
+        return None
+    return key
+
+def query_history_page(user_id, cursor=None, limit=HISTORY_PAGE_SIZE, since=None, until=None):
+    # One page of questions, newest first, without the (large) response bodies
+    key_condition = Key('user_id').eq(user_id)
+    if since and until:
+        key_condition &= Key('timestamp').between(since, until)
+    elif since:
+        key_condition &= Key('timestamp').gte(since)
+    elif until:
+        key_condition &= Key('timestamp').lte(until)
+
+    query = {
+        'KeyConditionExpression': key_condition,
+        'ProjectionExpression': '#ts, user_question',
+        'ExpressionAttributeNames': {'#ts': 'timestamp'},
+        'ScanIndexForward': False,  # Descending order
+        'Limit': limit,
+    }
+    if cursor:
+        query['ExclusiveStartKey'] = cursor
+
+    response = chat_history_table.query(**query)
+    entries = [
+        {"timestamp": item['timestamp'], "user_question": item.get('user_question')}
+        for item in response['Items']
+    ]
+    return entries, encode_history_cursor(response.get('LastEvaluatedKey'))
+
 @app.route("/history")
 def history():
     if 'username' not in session:
         return redirect(url_for('login'))
 
+    chat_history, next_cursor = query_history_page(session['user_id'])
+    return render_template("history.html", chat_history=chat_history, next_cursor=next_cursor)
+
+@app.route("/history/entries")
+def history_entries():
+    if 'username' not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
     user_id = session['user_id']
-    response = chat_history_table.query(
-        KeyConditionExpression=Key('user_id').eq(user_id),
-        ScanIndexForward=False  # Descending order
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decode_history_cursor(request.args['cursor'], user_id)
+        if cursor is None:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+    entries, next_cursor = query_history_page(
+        user_id,
+        cursor=cursor,
+        limit=limit,
+        since=request.args.get('since'),
+        until=request.args.get('until'),
     )
-    items = response['Items']
-    chat_history = []
-    for item in items:
-        chat_history.append({
-            "timestamp": item['timestamp'],
-            "user_question": item['user_question'],
-            "chatbot_response": item['chatbot_response']
-        })
+    return jsonify({"entries": entries, "next_cursor": next_cursor})
+
+@app.route("/history/entry")
+def history_entry():
+    if 'username' not in session:
+        return jsonify({"error": "User not logged in"}), 401
+
+    timestamp = request.args.get('timestamp')
+    if not timestamp:
+        return jsonify({"error": "Missing timestamp"}), 400
 
-    return render_template("history.html", chat_history=chat_history)
+    response = chat_history_table.get_item(Key={'user_id': session['user_id'], 'timestamp': timestamp})
+    item = response.get('Item')
+    if not item:
+        return jsonify({"error": "Entry not found"}), 404
+
+    return jsonify({
+        "timestamp": item['timestamp'],
+        "user_question": item.get('user_question'),
+        "chatbot_response": item.get('chatbot_response')
+    })
 
 @app.route("/support", methods=["GET", "POST"])
 def support():
@@ -457,7 +1154,7 @@ def support():
         user_id = session['user_id']
         message = request.form["message"]
 
-        feedback_table.put_item(Item={
+        write_buffer.put(feedback_table, {
             'user_id': user_id,
             'timestamp': str(datetime.utcnow()),
             'feedback': message
@@ -469,53 +1166,57 @@ def support():
 
 @app.route("/logout")
 def logout():
+    if 'user_id' in session:
+        conversations.clear(session['user_id'])
+        chat_engines.reset(session['user_id'])
     session.pop('username', None)
     session.pop('user_id', None)
     return redirect(url_for('login'))
 
-def handle_checkout_session(session):
-    print("Handling checkout session...")
-    customer_email = session['customer_details']['email']
-    print(f"Customer email: {customer_email}")
+def handle_checkout_session(checkout_session):
+    customer_email = checkout_session['customer_details']['email']
 
-    response = users_table.scan(FilterExpression=Attr('email').eq(customer_email))
+    response = users_table.query(
+        IndexName='email-index',
+        KeyConditionExpression=Key('email').eq(customer_email),
+        ProjectionExpression='id'
+    )
     users = response['Items']
+    if not users:
+        log.warning("Checkout session user not found", extra={"fields": {"checkout_session": checkout_session.get('id')}})
+        return
 
-    if users:
-        user = users[0]
-        print(f"Found user: {user}")
-
-        user['user_type'] = 'pro'
-        users_table.put_item(Item=user)
-        print(f"Updated user: {user}")
-    else:
-        print("User not found")
-
-    print("Checkout session handling complete.")
+    # Only touch user_type, and never create an item for a user deleted meanwhile
+    update_user(users[0]['id'], "SET user_type = :pro", {':pro': 'pro'})
+    log.info("Upgraded user", extra={"fields": {"checkout_session": checkout_session.get('id'), "user_id": users[0]['id']}})
 
+webhook_queue = webhooks.WebhookQueue(os.getenv("WEBHOOK_QUEUE_PATH", "./webhook_events.db"))
+webhook_worker = webhooks.WebhookWorker(webhook_queue, {
+    'checkout.session.completed': handle_checkout_session,
+})
 
 @app.route('/webhook', methods=['POST'])
 def stripe_webhook():
-    print("Webhook received")
     payload = request.get_data(as_text=True)
-    print("Payload:", payload)
-    
     sig_header = request.headers.get('Stripe-Signature')
     endpoint_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
 
     try:
         event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
-        print("Event:", event)
     except ValueError as e:
-        print("ValueError:", e)
+        log.warning("Invalid webhook payload", extra={"fields": {"error": str(e)}})
         return jsonify(success=False), 400
     except stripe.error.SignatureVerificationError as e:
-        print("SignatureVerificationError:", e)
+        log.warning("Invalid webhook signature", extra={"fields": {"error": str(e)}})
         return jsonify(success=False), 400
 
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        handle_checkout_session(session)
+    # Queue the event and return straight away, the worker applies it
+    if event['type'] in webhook_worker.handlers:
+        if webhook_queue.enqueue(event['id'], event['type'], json.loads(payload)['data']['object']):
+            webhook_worker.ensure_started()
+            webhook_worker.notify()
+        else:
+            log.info("Webhook event already received", extra={"fields": {"event_id": event['id']}})
 
     return jsonify(success=True)
 
@@ -526,15 +1227,11 @@ def subscribe():
 
     if request.method == 'POST':
         user_id = session['user_id']
-        print(f"User ID from session: {user_id}")
 
-        response = users_table.get_item(Key={'id': user_id})
-        user = response.get('Item')
+        user = user_cache.get(user_id)
         if not user:
             return jsonify({"error": "User not found"})
 
-        print(f"User found: {user}")
-
         try:
             checkout_session = stripe.checkout.Session.create(
                 payment_method_types=['card'],
@@ -547,11 +1244,11 @@ def subscribe():
                 cancel_url=url_for('subscription_cancel', _external=True),
             )
 
-            print(f"Checkout session created: {checkout_session}")
+            log.info("Checkout session created", extra={"fields": {"user_id": user_id, "checkout_session": checkout_session['id']}})
 
             return jsonify({'checkout_session_id': checkout_session['id']})
         except Exception as e:
-            print(f"Error creating checkout session: {str(e)}")
+            log.exception("Error creating checkout session", extra={"fields": {"user_id": user_id}})
             return jsonify(error=str(e)), 403
 
     else:
@@ -564,12 +1261,8 @@ def subscription_success():
         return redirect(url_for('login'))
 
     user_id = session['user_id']
-    response = users_table.get_item(Key={'id': user_id})
-    user = response.get('Item')
-
-    if user:
-        user['user_type'] = 'pro'
-        users_table.put_item(Item=user)
+    if user_cache.get(user_id):
+        update_user(user_id, "SET user_type = :pro", {':pro': 'pro'})
 
     return render_template('subscription_success.html')
 
@@ -587,7 +1280,7 @@ def feedback():
     feedback_text = request.json["feedback"]
     user_id = session['user_id']
 
-    feedback_table.put_item(Item={
+    write_buffer.put(feedback_table, {
         'user_id': user_id,
         'timestamp': str(datetime.utcnow()),
         'feedback': feedback_text
@@ -595,6 +1288,48 @@ def feedback():
 
     return jsonify({"message": "Thank you for your feedback!"})
 
+@app.cli.command("init-db")
+def init_db_command():
+    setup_tables()
+
+@app.cli.command("ingest")
+def ingest_command():
+    page_store.reingest()
+
+@app.cli.command("rebuild-index")
+def rebuild_index_command():
+    index_store.rebuild()
+    page_index.rebuild()
+
+@app.cli.command("refresh-index")
+def refresh_index_command():
+    index_store.refresh()
+    page_index.get_page_index()
+
+@app.cli.command("batch-qa")
+@click.argument("questions", type=click.File("r"))
+@click.argument("output")
+@click.option("--concurrency", default=BATCH_CONCURRENCY, show_default=True, help="questions answered at a time")
+def batch_qa_command(questions, output, concurrency):
+    # Answers the QUESTIONS (JSONL) and appends the results to OUTPUT as
+    # JSONL; rerun with the same OUTPUT to resume after an interruption
+    items = list(batch_qa.read_questions(questions))
+    out, completed = batch_qa.open_output(output)
+    warm_up()
+    answered = failed = 0
+    with out:
+        for record in batch_qa.run_batch(items, batch_answer, concurrency, completed):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            if "error" in record:
+                failed += 1
+            else:
+                answered += 1
+    skipped = len({question_id for question_id, _ in items} & completed)
+    click.echo(f"{answered} answered, {failed} failed, {skipped} already done")
+
+startup.record("import app", time.perf_counter() - _import_started)
 
 if __name__ == "__main__":
+    start_warm_up()
     app.run(debug=True)
@@ -0,0 +1,289 @@
+import asyncio
+import contextlib
+import functools
+import os
+import time
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app
+import http_clients
+import telemetry
+
+# Async serving mode: the LLM-bound routes run on the event loop, so a waiting
+# chat costs a coroutine rather than a thread, and every other route is the
+# unchanged Flask app on a thread pool. Run with
+#   uvicorn asgi:application --workers N
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", 64))
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", 16))
+
+log = telemetry.get_logger("asgi")
+_upstream = None
+
+
+def upstream():
+    # Bounds in-flight OpenAI calls across all async requests in the process
+    global _upstream
+    if _upstream is None:
+        _upstream = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+    return _upstream
+
+
+def session_user(request):
+    # Reads the Flask session cookie, so a login through the Flask routes applies here too
+    flask_app = app.app
+    cookie = request.cookies.get(flask_app.config["SESSION_COOKIE_NAME"])
+    if not cookie:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        data = serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data if 'username' in data else None
+
+
+def audio_url(key):
+    return app.app.url_map.bind("").build("audio", {"key": key}) if key else None
+
+
+def traced(endpoint):
+    # Same trace, X-Request-ID header and request metrics as the Flask hooks;
+    # a streamed response is finished once its body is done
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            trace = telemetry.begin(request.headers.get("X-Request-ID"))
+            try:
+                response = await handler(request)
+            except Exception:
+                telemetry.finish_request(trace, request.method, endpoint, 500)
+                raise
+            response.headers["X-Request-ID"] = trace.trace_id
+            if not isinstance(response, StreamingResponse):
+                telemetry.finish_request(trace, request.method, endpoint, response.status_code)
+                return response
+
+            body = response.body_iterator
+
+            async def finish_after_body():
+                try:
+                    async for chunk in body:
+                        yield chunk
+                finally:
+                    telemetry.finish_request(trace, request.method, endpoint, response.status_code)
+            response.body_iterator = finish_after_body()
+            return response
+        return wrapper
+    return decorator
+
+
+async def check_ready():
+    app.start_warm_up()
+    app.webhook_worker.ensure_started()
+    missing = await run_in_threadpool(app.missing_tables)
+    if missing:
+        return JSONResponse({"error": f"Service is not ready, missing tables: {', '.join(missing)}"}, status_code=503)
+    return None
+
+
+async def lookup_cached_answer(user_question, user_id=None):
+    # See app.lookup_cached_answer
+    version = await run_in_threadpool(app.index_store.index_version)
+    if user_id is not None and app.chat_engines.has_history(user_id):
+        return None, version, None
+    embed_model = await run_in_threadpool(app.index_store.embed_model)
+    with telemetry.stage("answer_cache"):
+        async with upstream():
+            question_embedding = await embed_model.aget_query_embedding(user_question)
+        return question_embedding, version, app.answer_cache.lookup(question_embedding, version)
+
+
+async def generate_additional_questions(response_text, num_questions=app.FOLLOWUP_QUESTION_COUNT):
+    query_engine = await run_in_threadpool(app.initialize_chatbot, num_questions)
+    async with upstream():
+        response = await query_engine.aquery(response_text)
+    if not response or not response.response:
+        return []
+    return app.parse_question_list(response.response, num_questions)
+
+
+POST_ANSWER_STAGES = {
+    "audio": lambda response_text: run_in_threadpool(app.tts_cache.register, response_text),
+    "additional_questions": generate_additional_questions,
+}
+
+
+async def run_stage(stage, response_text):
+    # Returns (stage, result); a stage that fails or times out gives None
+    try:
+        with telemetry.stage(stage):
+            return stage, await asyncio.wait_for(POST_ANSWER_STAGES[stage](response_text), app.STAGE_TIMEOUTS[stage])
+    except asyncio.TimeoutError:
+        telemetry.stage_failed(stage, "timeout")
+        log.warning("Stage timed out", extra={"fields": {"stage": stage, "timeout": app.STAGE_TIMEOUTS[stage]}})
+    except Exception:
+        telemetry.stage_failed(stage, "error")
+        log.warning("Stage failed", exc_info=True, extra={"fields": {"stage": stage}})
+    return stage, None
+
+
+def iter_post_answer_stages(response_text):
+    return asyncio.as_completed([run_stage(stage, response_text) for stage in POST_ANSWER_STAGES])
+
+
+async def generate_response(user_question, user_id=None):
+    question_embedding, version, cached = await lookup_cached_answer(user_question, user_id)
+    if cached:
+        response_text, additional_questions, document_session, document_sources = cached
+        if user_id is not None:
+            await run_in_threadpool(app.chat_engines.record_turn, user_id, user_question, response_text)
+        audio_key = await run_in_threadpool(app.tts_cache.register, response_text)
+        return response_text, additional_questions, audio_url(audio_key), document_session, document_sources
+
+    async with app.chat_engines.asession(user_id) as chat_engine, upstream():
+        with telemetry.stage("chat"):
+            response = await chat_engine.achat(user_question)
+    if not response:
+        return None, None, None, None, None
+
+    response_text = response.response
+    document_session, document_sources = await run_in_threadpool(app.document_section_from_nodes, response.source_nodes, response_text)
+    stages = dict([await result for result in iter_post_answer_stages(response_text)])
+    additional_questions = stages["additional_questions"]
+    if additional_questions is not None:
+        app.store_cached_answer(question_embedding, version, (response_text, additional_questions, document_session, document_sources))
+    return response_text, additional_questions, audio_url(stages["audio"]), document_session, document_sources
+
+
+async def begin_chat(request):
+    # Shared checks of /chat and /chat/stream: returns (error response, user_id, question, quota)
+    not_ready = await check_ready()
+    if not_ready:
+        return not_ready, None, None, None
+    user = session_user(request)
+    if user is None:
+        return JSONResponse({"error": "User not logged in"}), None, None, None
+
+    user_question = (await request.json())["user_question"]
+    user_id = user['user_id']
+    user_quota = await run_in_threadpool(app.consume_question, user_id)
+    if not user_quota.allowed:
+        return JSONResponse({"error": user_quota.error}), None, None, None
+    return None, user_id, user_question, user_quota
+
+
+@traced("chat")
+async def chat(request):
+    error, user_id, user_question, user_quota = await begin_chat(request)
+    if error:
+        return error
+
+    response_text, additional_questions, audio, document_session, document_sources = await generate_response(user_question, user_id)
+    if response_text:
+        await run_in_threadpool(app.record_chat, user_id, user_question, response_text)
+        await run_in_threadpool(app.record_additional_questions, user_id, additional_questions)
+
+    return JSONResponse({"response_text": response_text, "additional_questions": additional_questions, "audio_url": audio, "document_session": document_session, "document_sources": document_sources, "remaining_questions": user_quota.remaining})
+
+
+@traced("chat_stream")
+async def chat_stream(request):
+    error, user_id, user_question, user_quota = await begin_chat(request)
+    if error:
+        return error
+    sse_event = app.sse_event
+
+    async def cached_events(cached):
+        response_text, additional_questions, document_session, document_sources = cached
+        await run_in_threadpool(app.chat_engines.record_turn, user_id, user_question, response_text)
+        yield sse_event("token", {"text": response_text})
+        yield sse_event("answer", {"response_text": response_text, "remaining_questions": user_quota.remaining})
+        await run_in_threadpool(app.record_chat, user_id, user_question, response_text)
+        audio_key = await run_in_threadpool(app.tts_cache.register, response_text)
+        yield sse_event("audio", {"audio_url": audio_url(audio_key)})
+        yield sse_event("document_session", {"document_session": document_session, "document_sources": document_sources})
+        await run_in_threadpool(app.record_additional_questions, user_id, additional_questions)
+        yield sse_event("additional_questions", {"additional_questions": additional_questions})
+        yield sse_event("done", {})
+
+    async def events():
+        question_embedding, version, cached = await lookup_cached_answer(user_question, user_id)
+        if cached:
+            async for event in cached_events(cached):
+                yield event
+            return
+
+        tokens = []
+        async with app.chat_engines.asession(user_id) as chat_engine, upstream():
+            with telemetry.stage("chat"):
+                started = time.perf_counter()
+                streaming_response = await chat_engine.astream_chat(user_question)
+                async for token in streaming_response.async_response_gen():
+                    if not tokens:
+                        telemetry.observe_stage("first_token", time.perf_counter() - started)
+                    tokens.append(token)
+                    yield sse_event("token", {"text": token})
+
+        response_text = "".join(tokens)
+        if not response_text:
+            yield sse_event("error", {"error": "No response generated"})
+            return
+        yield sse_event("answer", {"response_text": response_text, "remaining_questions": user_quota.remaining})
+        await run_in_threadpool(app.record_chat, user_id, user_question, response_text)
+
+        document_session, document_sources = await run_in_threadpool(app.document_section_from_nodes, streaming_response.source_nodes, response_text)
+        yield sse_event("document_session", {"document_session": document_session, "document_sources": document_sources})
+
+        additional_questions = None
+        for result in iter_post_answer_stages(response_text):
+            stage, value = await result
+            if stage == "audio":
+                yield sse_event("audio", {"audio_url": audio_url(value)})
+            elif stage == "additional_questions":
+                additional_questions = value
+                await run_in_threadpool(app.record_additional_questions, user_id, additional_questions)
+                yield sse_event("additional_questions", {"additional_questions": additional_questions})
+
+        if additional_questions is not None:
+            app.store_cached_answer(question_embedding, version, (response_text, additional_questions, document_session, document_sources))
+        yield sse_event("done", {})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    app.start_warm_up()
+    yield
+    await http_clients.aclose()
+
+
+application = Starlette(
+    routes=[
+        Route("/chat", chat, methods=["POST"]),
+        Route("/chat/stream", chat_stream, methods=["POST"]),
+        Mount("/", app=WSGIMiddleware(app.app, workers=WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "asgi:application",
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", 8000)),
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+    )
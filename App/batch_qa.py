@@ -0,0 +1,89 @@
+import contextvars
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+import telemetry
+
+log = telemetry.get_logger("batch")
+
+
+def read_questions(lines):
+    # One {"id": ..., "question": ...} object per line; the id defaults to the line number
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise ValueError(f"line {number}: not valid JSON")
+        question = (item.get("question") or item.get("user_question")) if isinstance(item, dict) else None
+        if not question:
+            raise ValueError(f"line {number}: no question")
+        yield str(item.get("id", number)), question
+
+
+def completed_ids(lines):
+    # Ids answered by an earlier, possibly interrupted, run. Failed ones are
+    # answered again and a line cut short by the interruption is ignored.
+    done = set()
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(record, dict) and "id" in record and "error" not in record:
+            done.add(str(record["id"]))
+    return done
+
+
+def open_output(path):
+    # Opens results for appending and returns (file, completed ids). A rerun
+    # after a failure appends a new record for the id, so the last one counts.
+    done = set()
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        done = completed_ids(content.decode('utf-8', errors='replace').splitlines())
+        if content and not content.endswith(b"\n"):
+            with open(path, 'ab') as f:
+                f.write(b"\n")
+    return open(path, 'a'), done
+
+
+def answer(question_id, question, answer_fn):
+    # answer_fn(question) returns the fields of the record; the stages it ran
+    # are timed through the trace started here
+    trace = telemetry.begin()
+    record = {"id": question_id, "question": question}
+    try:
+        record.update(answer_fn(question))
+    except Exception as e:
+        log.warning("Batch question failed", exc_info=True, extra={"fields": {"id": question_id}})
+        record["error"] = str(e)
+    record["seconds"] = round(time.perf_counter() - trace.started, 3)
+    record["stages_ms"] = {name: round(value * 1000, 1) for name, value in trace.stages.items()}
+    record["tokens"] = dict(trace.tokens)
+    return record
+
+
+def run_batch(items, answer_fn, concurrency=4, skip=()):
+    # Yields the record of each (id, question) as it is answered, with at most
+    # `concurrency` in flight. Ids in `skip` and repeated ids are left out.
+    seen = set(skip)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as executor:
+        pending = set()
+        for question_id, question in items:
+            if question_id in seen:
+                continue
+            seen.add(question_id)
+            if len(pending) >= concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            # A fresh context per question, so each has its own trace
+            pending.add(executor.submit(contextvars.Context().run, answer, question_id, question, answer_fn))
+        for future in as_completed(pending):
+            yield future.result()
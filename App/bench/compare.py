@@ -0,0 +1,60 @@
+import argparse
+import json
+import sys
+
+
+def _rows(results):
+    # (corpus pages, kind, name) -> stats
+    rows = {}
+    for run in results["runs"]:
+        pages = run["corpus"]["pages"]
+        rows[(pages, "throughput", "requests")] = {"rps": run["throughput_rps"]}
+        rows[(pages, "memory", "peak_rss_mb")] = {"mb": run["peak_rss_mb"]}
+        for kind in ("endpoints", "stages"):
+            for name, stats in run[kind].items():
+                if stats["count"]:
+                    rows[(pages, kind, name)] = stats
+    return rows
+
+
+def _change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+
+def compare(baseline, candidate, metric="p95", threshold=10.0):
+    # Prints the change of every shared row; returns the rows that got worse by more than threshold percent
+    before, after = _rows(baseline), _rows(candidate)
+    regressions = []
+    print(f"baseline {baseline.get('commit')}  candidate {candidate.get('commit')}  ({metric}, threshold {threshold}%)")
+    for key in sorted(set(before) & set(after), key=lambda key: (key[0], key[1], key[2])):
+        pages, kind, name = key
+        field = {"throughput": "rps", "memory": "mb"}.get(kind, metric)
+        old, new = before[key][field], after[key][field]
+        change = _change(old, new)
+        # Higher throughput is better, everything else is lower-is-better
+        worse = -change if kind == "throughput" else change
+        flag = "  REGRESSION" if worse > threshold else ""
+        if flag:
+            regressions.append(key)
+        print(f"  {pages:>6} pages  {kind:10} {name:24} {old:>10} -> {new:>10}  {change:+7.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--metric", default="p95", choices=("p50", "p95", "p99", "mean", "max"))
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent change that counts as a regression")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    regressions = compare(baseline, candidate, args.metric, args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
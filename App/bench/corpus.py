@@ -0,0 +1,59 @@
+import os
+import random
+
+VOCABULARY = """
+concrete slab footing foundation beam column rebar reinforcement formwork curing mortar masonry brick block
+timber framing stud joist rafter truss plywood sheathing insulation vapour barrier membrane waterproofing
+drainage gutter downpipe flashing roofing tile cladding render plaster drywall ceiling partition stair
+handrail balustrade excavation backfill compaction gravel aggregate cement admixture grout anchor bolt
+weld steel lintel bearing load deflection span tension compression shear moment stiffness settlement
+moisture crack shrinkage expansion joint sealant fire rating acoustic thermal ventilation scaffold
+crane excavator surveyor inspection certificate permit tolerance specification drawing schedule
+contractor engineer architect supervisor safety hazard harness guardrail trench shoring retaining wall
+pile pier culvert pavement asphalt kerb subgrade geotextile termite treatment durability corrosion
+""".split()
+
+QUESTION_TEMPLATES = (
+    "What is the recommended {0} for {1} {2}?",
+    "How do I check {0} in a {1}?",
+    "Why does {0} cause {1} in {2}?",
+    "When should {0} be installed before {1}?",
+    "What tolerance applies to {0} and {1}?",
+    "How is {0} protected from {1}?",
+)
+
+
+def _sentence(rng):
+    words = rng.choices(VOCABULARY, k=rng.randint(8, 16))
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng):
+    return " ".join(_sentence(rng) for _ in range(rng.randint(3, 6)))
+
+
+def build_corpus(data_dir, pages, pages_per_pdf=20, seed=0):
+    # Synthetic PDFs of construction-flavoured text, the same for the same seed
+    import fitz
+
+    rng = random.Random(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    total_bytes = 0
+    pdfs = 0
+    for start in range(0, pages, pages_per_pdf):
+        doc = fitz.open()
+        for _ in range(min(pages_per_pdf, pages - start)):
+            page = doc.new_page()
+            text = "\n\n".join(_paragraph(rng) for _ in range(4))
+            page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), text, fontsize=9)
+        path = os.path.join(data_dir, f"synthetic_{pdfs:04d}.pdf")
+        doc.save(path)
+        doc.close()
+        total_bytes += os.path.getsize(path)
+        pdfs += 1
+    return {"pages": pages, "pdfs": pdfs, "bytes": total_bytes}
+
+
+def questions(count, seed=0):
+    rng = random.Random(seed)
+    return [rng.choice(QUESTION_TEMPLATES).format(*rng.sample(VOCABULARY, 3)) for _ in range(count)]
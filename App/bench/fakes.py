@@ -0,0 +1,492 @@
+import copy
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+def _wire(item):
+    return {name: _serializer.serialize(value) for name, value in item.items()}
+
+
+def _normalize(item):
+    # Round trip through the wire format so numbers come back as Decimal, like boto3
+    return {name: _deserializer.deserialize(value) for name, value in _wire(item).items()}
+
+
+class ResourceNotFoundException(ClientError):
+    pass
+
+
+class ResourceInUseException(ClientError):
+    pass
+
+
+class ConditionalCheckFailedException(ClientError):
+    pass
+
+
+def _error(cls, operation, message, **extra):
+    response = {'Error': {'Code': cls.__name__, 'Message': message}}
+    response.update(extra)
+    return cls(response, operation)
+
+
+def evaluate(condition, item):
+    # Evaluates a boto3 Key/Attr condition against a plain item (top-level attributes only)
+    expression = condition.get_expression()
+    operator, values = expression['operator'], expression['values']
+    if operator == 'AND':
+        return all(evaluate(value, item) for value in values)
+    if operator == 'OR':
+        return any(evaluate(value, item) for value in values)
+    if operator == 'NOT':
+        return not evaluate(values[0], item)
+
+    name = values[0].name
+    if operator == 'attribute_exists':
+        return name in item
+    if operator == 'attribute_not_exists':
+        return name not in item
+    if name not in item:
+        return False
+    value, operands = item[name], values[1:]
+    try:
+        if operator == '=':
+            return value == operands[0]
+        if operator == '<>':
+            return value != operands[0]
+        if operator == '<':
+            return value < operands[0]
+        if operator == '<=':
+            return value <= operands[0]
+        if operator == '>':
+            return value > operands[0]
+        if operator == '>=':
+            return value >= operands[0]
+        if operator == 'BETWEEN':
+            return operands[0] <= value <= operands[1]
+    except TypeError:
+        return False
+    if operator == 'IN':
+        return value in operands[0]
+    if operator == 'begins_with':
+        return isinstance(value, str) and value.startswith(operands[0])
+    if operator == 'contains':
+        return operands[0] in value
+    raise NotImplementedError(f"Condition operator {operator} is not supported")
+
+
+def _split_top_level(text, separator=','):
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == separator and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    parts.append(current)
+    return [part.strip() for part in parts if part.strip()]
+
+
+def _apply_update(item, expression, names, values):
+    # SET clauses with +/- arithmetic and if_not_exists, evaluated against the old item
+    action, _, body = expression.strip().partition(' ')
+    if action.upper() != 'SET':
+        raise NotImplementedError(f"Update action {action} is not supported")
+
+    def attribute(token):
+        return names.get(token, token) if token.startswith('#') else token
+
+    def operand(token):
+        token = token.strip()
+        match = re.fullmatch(r'if_not_exists\((.+)\)', token)
+        if match:
+            path, default = _split_top_level(match.group(1))
+            return item[attribute(path)] if attribute(path) in item else operand(default)
+        if token.startswith(':'):
+            return values[token]
+        return item[attribute(token)]
+
+    updated = dict(item)
+    for assignment in _split_top_level(body):
+        target, _, source = assignment.partition('=')
+        tokens = re.split(r'\s*([+-])\s*', source.strip())
+        result = operand(tokens[0])
+        for op, token in zip(tokens[1::2], tokens[2::2]):
+            result = result + operand(token) if op == '+' else result - operand(token)
+        updated[attribute(target.strip())] = result
+    return _normalize(updated)
+
+
+def _project(item, projection, names):
+    if not projection:
+        return copy.deepcopy(item)
+    attributes = [names.get(name, name) for name in _split_top_level(projection)]
+    return {name: copy.deepcopy(item[name]) for name in attributes if name in item}
+
+
+class _Events:
+    # Enough of botocore's hierarchical event emitter for before-call/after-call hooks
+    def __init__(self):
+        self._handlers = []
+
+    def register(self, event_name, handler):
+        self._handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for name, handler in self._handlers:
+            if event_name == name or event_name.startswith(name + '.'):
+                handler(event_name=event_name, **kwargs)
+
+
+class _Waiter:
+    def wait(self, **kwargs):
+        pass
+
+
+class FakeDynamoDBClient:
+    exceptions = SimpleNamespace(
+        ResourceNotFoundException=ResourceNotFoundException,
+        ResourceInUseException=ResourceInUseException,
+        ConditionalCheckFailedException=ConditionalCheckFailedException,
+    )
+
+    def __init__(self, db):
+        self._db = db
+        self.meta = SimpleNamespace(
+            service_model=SimpleNamespace(service_name='dynamodb'),
+            events=_Events(),
+        )
+
+    def _call(self, operation, fn):
+        model = SimpleNamespace(name=operation)
+        context = {}
+        self.meta.events.emit(f"before-call.dynamodb.{operation}", model=model, params={}, context=context)
+        if self._db.latency:
+            time.sleep(self._db.latency)
+        result = fn()
+        self.meta.events.emit(f"after-call.dynamodb.{operation}", model=model, parsed=result, http_response=None, context=context)
+        return result
+
+    def get_waiter(self, name):
+        return _Waiter()
+
+    def describe_table(self, TableName):
+        def describe():
+            state = self._db.tables.get(TableName)
+            if state is None:
+                raise _error(ResourceNotFoundException, 'DescribeTable', f"Table {TableName} not found")
+            return {'Table': {'TableName': TableName, 'TableStatus': 'ACTIVE', 'ItemCount': len(state.items)}}
+        return self._call('DescribeTable', describe)
+
+
+class _TableState:
+    def __init__(self, key_schema, indexes):
+        self.hash_key, self.range_key = _keys(key_schema)
+        self.indexes = {index['IndexName']: _keys(index['KeySchema']) for index in indexes}
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def key_of(self, item):
+        return (item[self.hash_key], item.get(self.range_key) if self.range_key else None)
+
+    def key_dict(self, item):
+        return {name: item[name] for name in (self.hash_key, self.range_key) if name}
+
+
+def _keys(key_schema):
+    hash_key = next(key['AttributeName'] for key in key_schema if key['KeyType'] == 'HASH')
+    range_key = next((key['AttributeName'] for key in key_schema if key['KeyType'] == 'RANGE'), None)
+    return hash_key, range_key
+
+
+class _BatchWriter:
+    # Collects puts and writes them as one BatchWriteItem call on exit
+    def __init__(self, table, overwrite_by_pkeys):
+        self._table = table
+        self._keys = overwrite_by_pkeys
+        self._items = []
+
+    def put_item(self, Item):
+        if self._keys:
+            key = [Item.get(name) for name in self._keys]
+            self._items = [item for item in self._items if [item.get(name) for name in self._keys] != key]
+        self._items.append(Item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None and self._items:
+            def write():
+                state = self._table._state('BatchWriteItem')
+                with state.lock:
+                    for item in self._items:
+                        item = _normalize(item)
+                        state.items[state.key_of(item)] = item
+                return {'UnprocessedItems': {}}
+            self._table._call('BatchWriteItem', write)
+
+
+class FakeTable:
+    def __init__(self, db, name):
+        self._db = db
+        self.name = name
+        self.meta = SimpleNamespace(client=db.meta.client)
+
+    def _state(self, operation):
+        state = self._db.tables.get(self.name)
+        if state is None:
+            raise _error(ResourceNotFoundException, operation, f"Table {self.name} not found")
+        return state
+
+    def _call(self, operation, fn):
+        return self._db.meta.client._call(operation, fn)
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        def put():
+            state = self._state('PutItem')
+            item = _normalize(Item)
+            with state.lock:
+                old = state.items.get(state.key_of(item), {})
+                if ConditionExpression is not None and not evaluate(ConditionExpression, old):
+                    raise _error(ConditionalCheckFailedException, 'PutItem', "The conditional request failed")
+                state.items[state.key_of(item)] = item
+            return {}
+        return self._call('PutItem', put)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self, overwrite_by_pkeys)
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        def get():
+            state = self._state('GetItem')
+            with state.lock:
+                item = state.items.get(state.key_of(_normalize(Key)))
+                if item is None:
+                    return {}
+                return {'Item': _project(item, ProjectionExpression, ExpressionAttributeNames or {})}
+        return self._call('GetItem', get)
+
+    def delete_item(self, Key, **kwargs):
+        def delete():
+            state = self._state('DeleteItem')
+            with state.lock:
+                state.items.pop(state.key_of(_normalize(Key)), None)
+            return {}
+        return self._call('DeleteItem', delete)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues='NONE', ReturnValuesOnConditionCheckFailure='NONE', **kwargs):
+        def update():
+            state = self._state('UpdateItem')
+            key = _normalize(Key)
+            with state.lock:
+                old = state.items.get(state.key_of(key))
+                if ConditionExpression is not None and not evaluate(ConditionExpression, old or {}):
+                    extra = {}
+                    if old is not None and ReturnValuesOnConditionCheckFailure == 'ALL_OLD':
+                        extra['Item'] = _wire(old)
+                    raise _error(ConditionalCheckFailedException, 'UpdateItem', "The conditional request failed", **extra)
+                new = _apply_update(old or key, UpdateExpression, ExpressionAttributeNames or {}, _normalize(ExpressionAttributeValues or {}))
+                state.items[state.key_of(new)] = new
+            if ReturnValues == 'ALL_NEW':
+                return {'Attributes': copy.deepcopy(new)}
+            if ReturnValues == 'ALL_OLD' and old is not None:
+                return {'Attributes': copy.deepcopy(old)}
+            return {}
+        return self._call('UpdateItem', update)
+
+    def query(self, KeyConditionExpression, IndexName=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+              ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, FilterExpression=None, **kwargs):
+        def query():
+            state = self._state('Query')
+            hash_key, range_key = state.indexes[IndexName] if IndexName else (state.hash_key, state.range_key)
+            with state.lock:
+                matches = [item for item in state.items.values() if evaluate(KeyConditionExpression, item)]
+            matches.sort(key=lambda item: (item.get(range_key, '') if range_key else '', state.key_of(item)), reverse=not ScanIndexForward)
+
+            if ExclusiveStartKey:
+                start = state.key_of(_normalize(ExclusiveStartKey))
+                positions = [i for i, item in enumerate(matches) if state.key_of(item) == start]
+                matches = matches[positions[0] + 1:] if positions else []
+
+            page = matches[:Limit] if Limit else matches
+            response = {}
+            if Limit and len(matches) > Limit:
+                last = page[-1]
+                last_key = state.key_dict(last)
+                last_key.update({name: last[name] for name in (hash_key, range_key) if name})
+                response['LastEvaluatedKey'] = last_key
+            if FilterExpression is not None:
+                page = [item for item in page if evaluate(FilterExpression, item)]
+            names = ExpressionAttributeNames or {}
+            response['Items'] = [_project(item, ProjectionExpression, names) for item in page]
+            response['Count'] = len(page)
+            return response
+        return self._call('Query', query)
+
+
+class FakeDynamoDB:
+    # In-memory stand-in for boto3's DynamoDB service resource
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.tables = {}
+        self.meta = SimpleNamespace(client=FakeDynamoDBClient(self))
+
+    def Table(self, name):
+        return FakeTable(self, name)
+
+    def create_table(self, TableName, KeySchema, AttributeDefinitions=None, ProvisionedThroughput=None, GlobalSecondaryIndexes=(), **kwargs):
+        def create():
+            if TableName in self.tables:
+                raise _error(ResourceInUseException, 'CreateTable', f"Table {TableName} already exists")
+            self.tables[TableName] = _TableState(KeySchema, GlobalSecondaryIndexes or ())
+            return FakeTable(self, TableName)
+        return self.meta.client._call('CreateTable', create)
+
+
+def _words(text):
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+
+def _fake_llm_class():
+    from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+    from llama_index.core.llms.callbacks import llm_completion_callback
+
+    class FakeLLM(CustomLLM):
+        # Deterministic answers built from the prompt's context, with a fixed
+        # time to first token plus a per-token delay
+        latency: float = 0.0
+        token_latency: float = 0.0
+        answer_tokens: int = 60
+
+        @property
+        def metadata(self):
+            return LLMMetadata(context_window=4096, num_output=512, model_name="fake-llm")
+
+        def _answer(self, prompt):
+            if "Standalone question" in prompt:
+                match = re.search(r"Follow Up Input:\s*(.+)", prompt)
+                return match.group(1).strip() if match else prompt.strip().splitlines()[-1]
+            sections = prompt.split("---------------------")
+            context = sections[1] if len(sections) >= 3 else prompt
+            words = [word for word in _words(context) if len(word) > 3]
+            if "JSON array" in prompt:
+                seed = int(hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8], 16)
+                picks = [words[(seed + i * 7) % len(words)] for i in range(6)] if words else ["construction"] * 6
+                return json.dumps([f"What is the role of {picks[2 * i]} in {picks[2 * i + 1]}?" for i in range(3)])
+            return " ".join(words[:self.answer_tokens]).capitalize() + "."
+
+        def _usage(self, prompt, text):
+            return {"usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": len(text.split())}}
+
+        @llm_completion_callback()
+        def complete(self, prompt, formatted=False, **kwargs):
+            text = self._answer(prompt)
+            time.sleep(self.latency + self.token_latency * len(text.split()))
+            return CompletionResponse(text=text, raw=self._usage(prompt, text))
+
+        @llm_completion_callback()
+        def stream_complete(self, prompt, formatted=False, **kwargs):
+            answer = self._answer(prompt)
+
+            def gen():
+                time.sleep(self.latency)
+                text = ""
+                for token in re.findall(r"\S+\s*", answer):
+                    time.sleep(self.token_latency)
+                    text += token
+                    yield CompletionResponse(text=text, delta=token, raw=self._usage(prompt, text))
+            return gen()
+
+    return FakeLLM
+
+
+def _fake_embedding_class():
+    from typing import List
+
+    from llama_index.core.base.embeddings.base import BaseEmbedding
+
+    class FakeEmbedding(BaseEmbedding):
+        # Hashed bag of words, so similar texts get similar vectors
+        dim: int = 256
+        latency: float = 0.0
+
+        @classmethod
+        def class_name(cls) -> str:
+            return "FakeEmbedding"
+
+        def _vector(self, text):
+            vector = [0.0] * self.dim
+            for word in _words(text):
+                vector[int(hashlib.md5(word.encode('utf-8')).hexdigest()[:8], 16) % self.dim] += 1.0
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            return [value / norm for value in vector]
+
+        def _get_query_embedding(self, query: str) -> List[float]:
+            time.sleep(self.latency)
+            return self._vector(query)
+
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            return self._get_query_embedding(query)
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            return self._get_text_embeddings([text])[0]
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            time.sleep(self.latency)
+            return [self._vector(text) for text in texts]
+
+    return FakeEmbedding
+
+
+class NoOpTTS:
+    def __init__(self, text, lang='en', **kwargs):
+        self.text = text
+
+    def save(self, path):
+        with open(path, 'wb'):
+            pass
+
+
+def install(dynamodb_latency=0.0, llm_latency=0.0, token_latency=0.0, embed_latency=0.0):
+    # Swaps DynamoDB, OpenAI and gTTS for the stand-ins above. Must run before
+    # app (and index_store) are imported, from the benchmark's working directory.
+    import boto3
+    import llama_index.embeddings.openai as openai_embeddings
+    import llama_index.llms.openai as openai_llms
+
+    db = FakeDynamoDB(dynamodb_latency)
+    boto3.resource = lambda service_name, *args, **kwargs: db
+    boto3.client = lambda service_name, *args, **kwargs: db.meta.client
+
+    fake_llm = _fake_llm_class()
+    fake_embedding = _fake_embedding_class()
+
+    def openai_llm(callback_manager=None, **kwargs):
+        llm = fake_llm(latency=llm_latency, token_latency=token_latency)
+        if callback_manager is not None:
+            llm.callback_manager = callback_manager
+        return llm
+
+    openai_llms.OpenAI = openai_llm
+    openai_embeddings.OpenAIEmbedding = lambda **kwargs: fake_embedding(model_name="fake-embedding", latency=embed_latency)
+
+    import tts_cache
+    tts_cache.gTTS = NoOpTTS
+    return db
@@ -0,0 +1,325 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+from bench import corpus, fakes
+
+# Each corpus runs in its own process, so module-level caches and RSS start clean
+BENCH_ENV = {
+    "SECRET_KEY": "bench",
+    "WARM_START": "0",
+    "CONVERSATION_BACKEND": "memory",
+    "EMBEDDING_BACKEND": "openai",
+    "QUESTION_LIMIT_BASIC": str(10 ** 9),
+    "QUESTION_LIMIT_PRO": str(10 ** 9),
+    "LOG_SAMPLE_RATE": "0",
+    "LOG_LEVEL": "WARNING",
+}
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    # Nearest rank
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    # Milliseconds
+    if not samples:
+        return {"count": 0}
+    return {
+        "count": len(samples),
+        "p50": round(percentile(samples, 50) * 1000, 2),
+        "p95": round(percentile(samples, 95) * 1000, 2),
+        "p99": round(percentile(samples, 99) * 1000, 2),
+        "mean": round(sum(samples) / len(samples) * 1000, 2),
+        "max": round(max(samples) * 1000, 2),
+    }
+
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RssSampler:
+    # Samples resident memory in the background and keeps the peak of each phase
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.phases = {}
+        self._peak = 0
+        self._stopped = threading.Event()
+        threading.Thread(target=self._run, name="rss-sampler", daemon=True).start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._peak = max(self._peak, current_rss())
+
+    @contextmanager
+    def phase(self, name):
+        self._peak = current_rss()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._peak = max(self._peak, current_rss())
+            self.phases[name] = {
+                "seconds": round(time.perf_counter() - started, 3),
+                "peak_rss_mb": round(self._peak / 2 ** 20, 1),
+            }
+
+    def stop(self):
+        self._stopped.set()
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ("chat", "chat_stream", "history", "login"):
+            raise argparse.ArgumentTypeError(f"Unknown endpoint in mix: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def seed_users(users_table, count):
+    users = []
+    for i in range(count):
+        user = {
+            "id": f"bench-user-{i}",
+            "username": f"bench{i}",
+            "password": "bench",
+            "email": f"bench{i}@example.com",
+            "registration_date": datetime.utcnow().isoformat(),
+            "user_type": "pro" if i % 4 == 0 else "basic",
+            "question_count": 0,
+            "last_question_date": datetime.utcnow().date().isoformat(),
+        }
+        users_table.put_item(Item=user)
+        users.append(user)
+    return users
+
+
+def request_once(client, endpoint, user, rng, questions):
+    # Returns (seconds, ok)
+    started = time.perf_counter()
+    if endpoint == "login":
+        response = client.post("/login", data={"email": user["email"], "password": user["password"]})
+        ok = response.status_code == 302
+    elif endpoint == "chat":
+        response = client.post("/chat", json={"user_question": rng.choice(questions)})
+        ok = response.status_code == 200 and "error" not in response.get_json()
+    elif endpoint == "chat_stream":
+        response = client.post("/chat/stream", json={"user_question": rng.choice(questions)})
+        ok = response.status_code == 200 and "event: done" in response.get_data(as_text=True)
+    else:
+        response = client.get("/history")
+        ok = response.status_code == 200
+    return time.perf_counter() - started, ok
+
+
+def drive_load(flask_app, users, questions, mix, concurrency, duration, seed):
+    # Each virtual user logs in once, then picks endpoints by weight until the deadline
+    samples = {endpoint: [] for endpoint in mix}
+    errors = {endpoint: 0 for endpoint in mix}
+    errors_lock = threading.Lock()
+    endpoints, weights = list(mix), list(mix.values())
+    deadline = time.perf_counter() + duration
+
+    def virtual_user(i):
+        rng = random.Random(seed + i)
+        user = users[i % len(users)]
+        client = flask_app.test_client()
+        client.post("/login", data={"email": user["email"], "password": user["password"]})
+        while time.perf_counter() < deadline:
+            endpoint = rng.choices(endpoints, weights)[0]
+            seconds, ok = request_once(client, endpoint, user, rng, questions)
+            samples[endpoint].append(seconds)
+            if not ok:
+                with errors_lock:
+                    errors[endpoint] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=virtual_user, args=(i,), name=f"vu-{i}") for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, errors, time.perf_counter() - started
+
+
+def run_corpus(config):
+    sampler = RssSampler()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workdir)
+    os.environ.update(BENCH_ENV)
+    try:
+        with sampler.phase("corpus"):
+            corpus_info = corpus.build_corpus("data", config["pages"], config["pages_per_pdf"], config["seed"])
+        questions = corpus.questions(config["questions"], config["seed"])
+
+        fakes.install(
+            dynamodb_latency=config["dynamodb_latency"],
+            llm_latency=config["llm_latency"],
+            token_latency=config["token_latency"],
+            embed_latency=config["embed_latency"],
+        )
+        with sampler.phase("import"):
+            import app
+            import index_store
+            import page_index
+            import page_store
+            import telemetry
+        app.setup_tables()
+        users = seed_users(app.users_table, config["users"])
+
+        with sampler.phase("ingest"):
+            page_store.get_page_store()
+        with sampler.phase("index"):
+            index_store.get_index()
+            page_index.get_page_index()
+
+        # Raw per-stage samples, on top of the histograms telemetry keeps
+        stage_samples = {}
+        observe_stage = telemetry.observe_stage
+
+        def record_stage(name, seconds):
+            observe_stage(name, seconds)
+            stage_samples.setdefault(name, []).append(seconds)
+
+        telemetry.observe_stage = record_stage
+        with sampler.phase("load"):
+            samples, errors, wall = drive_load(
+                app.app, users, questions, config["mix"], config["concurrency"], config["duration"], config["seed"])
+        telemetry.observe_stage = observe_stage
+
+        total = sum(len(endpoint_samples) for endpoint_samples in samples.values())
+        return {
+            "corpus": corpus_info,
+            "phases": sampler.phases,
+            "requests": total,
+            "throughput_rps": round(total / wall, 2),
+            "peak_rss_mb": round(max(phase["peak_rss_mb"] for phase in sampler.phases.values()), 1),
+            "endpoints": {
+                endpoint: dict(summarize(endpoint_samples), errors=errors[endpoint], throughput_rps=round(len(endpoint_samples) / wall, 2))
+                for endpoint, endpoint_samples in samples.items()
+            },
+            "stages": {name: summarize(values) for name, values in sorted(stage_samples.items())},
+        }
+    finally:
+        sampler.stop()
+        os.chdir(APP_DIR)
+        if not config["keep_workdir"]:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=APP_DIR).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def print_summary(runs):
+    for run in runs:
+        corpus_info = run["corpus"]
+        print(f"\n{corpus_info['pages']} pages in {corpus_info['pdfs']} PDFs: "
+              f"{run['throughput_rps']} req/s, peak RSS {run['peak_rss_mb']} MB")
+        print(f"  {'':24} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+        for name, stats in list(run["endpoints"].items()) + [(f"  {name}", stats) for name, stats in run["stages"].items()]:
+            if stats["count"]:
+                print(f"  {name:24} {stats['count']:>7} {stats['p50']:>9} {stats['p95']:>9} {stats['p99']:>9} {stats.get('errors', ''):>7}")
+        for name, phase in run["phases"].items():
+            print(f"  phase {name:18} {phase['seconds']:>8}s {phase['peak_rss_mb']:>8} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat pipeline against local stand-ins for OpenAI, DynamoDB and gTTS.")
+    parser.add_argument("--corpus-pages", default="20,100,500", help="comma-separated corpus sizes, in pages")
+    parser.add_argument("--pages-per-pdf", type=int, default=20)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load per corpus")
+    parser.add_argument("--mix", type=parse_mix, default="chat=6,history=3,login=1", help="endpoint weights")
+    parser.add_argument("--questions", type=int, default=200, help="distinct questions to draw from")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds to the first LLM token")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds per generated token")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="seconds per embedding batch")
+    parser.add_argument("--dynamodb-latency", type=float, default=0.005, help="seconds per DynamoDB call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-workdir", action="store_true")
+    parser.add_argument("--output", default=None, help="results file, defaults to bench_results/<time>-<commit>.json")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_corpus(json.loads(args.child))
+        with open(args.result_file, 'w') as f:
+            json.dump(result, f)
+        return
+
+    config = {name: value for name, value in vars(args).items() if name not in ("corpus_pages", "output", "child", "result_file")}
+    runs = []
+    for pages in [int(pages) for pages in args.corpus_pages.split(",")]:
+        print(f"Benchmarking a {pages}-page corpus...", flush=True)
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+            result_file = f.name
+        try:
+            subprocess.run(
+                [sys.executable, "-m", "bench.run", "--child", json.dumps(dict(config, pages=pages)), "--result-file", result_file],
+                cwd=APP_DIR,
+                check=True,
+            )
+            with open(result_file) as f:
+                runs.append(json.load(f))
+        finally:
+            os.remove(result_file)
+
+    commit, dirty = git_revision()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": config,
+        "runs": runs,
+    }
+    output = args.output or os.path.join(
+        "bench_results", f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'unknown'}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print_summary(runs)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+
+class _PooledEngine:
+    __slots__ = ("engine", "memory", "version", "lock", "waiters", "last_used")
+
+    def __init__(self, engine, memory, version):
+        self.engine = engine
+        self.memory = memory
+        self.version = version
+        self.lock = threading.Lock()
+        self.waiters = None  # asyncio.Lock queueing async requests, made on the event loop
+        self.last_used = time.monotonic()
+
+
+class ChatEnginePool:
+    # One condense_question chat engine per user session over the shared index
+
+    def __init__(self, index_getter, version_getter, callback_manager_getter=None, max_engines=200, idle_ttl=1800, memory_token_limit=1500):
+        self.index_getter = index_getter
+        self.callback_manager_getter = callback_manager_getter
+        self.version_getter = version_getter
+        self.max_engines = max_engines
+        self.idle_ttl = idle_ttl
+        self.memory_token_limit = memory_token_limit
+        self.created = 0
+        self.evicted = 0
+        self._engines = OrderedDict()
+        self._building = {}  # key -> Event set once its engine is published
+        self._lock = threading.Lock()
+
+    def _create(self, memory=None):
+        from llama_index.core.memory import ChatMemoryBuffer
+
+        if memory is None:
+            memory = ChatMemoryBuffer.from_defaults(token_limit=self.memory_token_limit)
+        index = self.index_getter()
+        options = {"callback_manager": self.callback_manager_getter()} if self.callback_manager_getter else {}
+        engine = index.as_chat_engine(chat_mode="condense_question", memory=memory, verbose=False, **options)
+        with self._lock:
+            self.created += 1
+        return _PooledEngine(engine, memory, self.version_getter())
+
+    def _checkout(self, key):
+        # Engines are built outside the pool lock, so a cold build (which may
+        # load the index) doesn't hold up other sessions; concurrent checkouts
+        # of the same key wait for its one build
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                for stale_key, entry in list(self._engines.items()):
+                    if now - entry.last_used <= self.idle_ttl:
+                        break
+                    del self._engines[stale_key]
+                    self.evicted += 1
+
+                entry = self._engines.get(key)
+                if entry is not None and entry.version == self.version_getter():
+                    self._engines.move_to_end(key)
+                    entry.last_used = now
+                    return entry
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = threading.Event()
+                    break
+            building.wait()
+
+        try:
+            # Keep the conversation when the index changed underneath the engine
+            entry = self._create(entry.memory if entry else None)
+            with self._lock:
+                self._engines[key] = entry
+                self._engines.move_to_end(key)
+                while len(self._engines) > self.max_engines:
+                    self._engines.popitem(last=False)
+                    self.evicted += 1
+            return entry
+        finally:
+            with self._lock:
+                del self._building[key]
+            building.set()
+
+    @contextmanager
+    def session(self, key):
+        # Yields the engine for `key`, one request at a time per session;
+        # a None key gets a throwaway engine with no history
+        entry = self._create() if key is None else self._checkout(key)
+        with entry.lock:
+            # Drop history beyond the token limit so the buffer stays bounded
+            entry.memory.set(entry.memory.get())
+            yield entry.engine
+
+    @asynccontextmanager
+    async def asession(self, key):
+        # Async counterpart of session(): building an engine runs off the event
+        # loop, and async requests for a busy session wait on an asyncio lock
+        # rather than tying up a thread each
+        if key is None:
+            entry = await asyncio.to_thread(self._create)
+        else:
+            entry = await asyncio.to_thread(self._checkout, key)
+        if entry.waiters is None:
+            entry.waiters = asyncio.Lock()
+        async with entry.waiters:
+            if not entry.lock.acquire(blocking=False):
+                # Held by a thread (a WSGI request or record_turn): one thread
+                # per session waits for it, shielded so a cancelled request
+                # can't leave the lock taken
+                acquiring = asyncio.ensure_future(asyncio.to_thread(entry.lock.acquire))
+                try:
+                    await asyncio.shield(acquiring)
+                except asyncio.CancelledError:
+                    acquiring.add_done_callback(lambda _: entry.lock.release())
+                    raise
+            try:
+                entry.memory.set(entry.memory.get())
+                yield entry.engine
+            finally:
+                entry.lock.release()
+
+    def has_history(self, key):
+        with self._lock:
+            entry = self._engines.get(key)
+        return bool(entry and entry.memory.get_all())
+
+    def record_turn(self, key, user_question, response_text):
+        # Used when an answer is served without going through the engine
+        from llama_index.core.llms import ChatMessage, MessageRole
+
+        entry = self._checkout(key)
+        with entry.lock:
+            entry.memory.put(ChatMessage(role=MessageRole.USER, content=user_question))
+            entry.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=response_text))
+
+    def reset(self, key):
+        with self._lock:
+            self._engines.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "engines": len(self._engines),
+                "max_engines": self.max_engines,
+                "created": self.created,
+                "evicted": self.evicted,
+                "idle_ttl": self.idle_ttl,
+                "memory_token_limit": self.memory_token_limit,
+            }
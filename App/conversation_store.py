@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+class Message:
+    __slots__ = ("role", "content", "type", "created")
+
+    def __init__(self, role, content, type='message', created=None):
+        self.role = role
+        self.content = content
+        self.type = type
+        self.created = time.time() if created is None else created
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content, "type": self.type}
+
+
+class InMemoryConversationStore:
+    # One fixed-size ring buffer of messages per session, idle sessions are evicted
+
+    def __init__(self, max_messages=50, idle_ttl=3600, sweep_interval=60):
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._conversations = {}
+        self._last_seen = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def append(self, key, role, content, type='message'):
+        now = time.monotonic()
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = deque(maxlen=self.max_messages)
+            conversation.append(Message(role, content, type))
+            self._last_seen[key] = now
+            if now - self._last_sweep > self.sweep_interval:
+                self._evict_idle(now)
+
+    def messages(self, key):
+        with self._lock:
+            conversation = self._conversations.get(key, ())
+            if conversation:
+                self._last_seen[key] = time.monotonic()
+            return [message.to_dict() for message in conversation]
+
+    def clear(self, key):
+        with self._lock:
+            self._conversations.pop(key, None)
+            self._last_seen.pop(key, None)
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle(time.monotonic())
+
+    def _evict_idle(self, now):
+        self._last_sweep = now
+        for key, last_seen in list(self._last_seen.items()):
+            if now - last_seen > self.idle_ttl:
+                del self._conversations[key]
+                del self._last_seen[key]
+
+    def __len__(self):
+        return len(self._conversations)
+
+
+class SqliteConversationStore:
+    # Same interface backed by a SQLite file, so several workers on one host share it
+
+    def __init__(self, path="./conversations.db", max_messages=50, idle_ttl=3600, sweep_interval=60):
+        self.path = path
+        self.max_messages = max_messages
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, session_key TEXT NOT NULL, "
+                "role TEXT, content TEXT, type TEXT, created REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_key, seq)")
+
+    def _connection(self):
+        # Reopened after fork, an inherited sqlite connection isn't safe to use
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def append(self, key, role, content, type='message'):
+        message = Message(role, content, type)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO messages (session_key, role, content, type, created) VALUES (?, ?, ?, ?, ?)",
+                (key, message.role, message.content, message.type, message.created),
+            )
+            conn.execute(
+                "DELETE FROM messages WHERE session_key = ? AND seq <= ("
+                "SELECT seq FROM messages WHERE session_key = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                (key, key, self.max_messages),
+            )
+        if time.monotonic() - self._last_sweep > self.sweep_interval:
+            self.evict_idle()
+
+    def messages(self, key):
+        rows = self._connection().execute(
+            "SELECT role, content, type FROM messages WHERE session_key = ? ORDER BY seq", (key,)
+        ).fetchall()
+        return [Message(role, content, type, 0).to_dict() for role, content, type in rows]
+
+    def clear(self, key):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM messages WHERE session_key = ?", (key,))
+
+    def evict_idle(self):
+        self._last_sweep = time.monotonic()
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM messages WHERE session_key IN ("
+                "SELECT session_key FROM messages GROUP BY session_key HAVING MAX(created) < ?)",
+                (time.time() - self.idle_ttl,),
+            )
+
+
+def create_store(backend=None):
+    backend = backend or os.getenv("CONVERSATION_BACKEND", "memory")
+    options = {
+        "max_messages": int(os.getenv("CONVERSATION_MAX_MESSAGES", 50)),
+        "idle_ttl": int(os.getenv("CONVERSATION_IDLE_TTL", 3600)),
+    }
+    if backend == "memory":
+        return InMemoryConversationStore(**options)
+    if backend == "sqlite":
+        return SqliteConversationStore(os.getenv("CONVERSATION_DB_PATH", "./conversations.db"), **options)
+    raise ValueError(f"Unknown conversation backend: {backend}")
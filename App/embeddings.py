@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+import http_clients
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: writes are only serialised between threads of one process
+    fcntl = None
+
+embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR", "./storage/embedding_cache")
+
+
+class EmbeddingStore:
+    # Append-only float32 matrix file read through a memory map, plus an
+    # append-only log of (key, row) lines. Processes may share the directory
+    # (e.g. the server and an index refresh): writers hold a file lock, and
+    # rows are numbered by the matrix file's length, so a key always points
+    # at the vector written for it.
+
+    def __init__(self, directory=embedding_cache_dir):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.keys_path = os.path.join(directory, "keys.jsonl")
+        self.lock_path = os.path.join(directory, "write.lock")
+        self.dim = None
+        self.rows = {}
+        self._keys_offset = 0
+        self._matrix = None
+        self._lock = threading.Lock()
+        with self._lock:
+            self._read_keys()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _read_keys(self):
+        # Reads the entries appended since the last call, by any process
+        try:
+            with open(self.keys_path, 'rb') as f:
+                f.seek(self._keys_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A line without its newline is still being written
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Cut short by a crash
+                continue
+            if isinstance(entry, dict):
+                self.dim = entry["dim"]
+            else:
+                key, row = entry
+                self.rows[key] = row
+        self._keys_offset += end
+
+    def _vectors(self, needed_rows):
+        if self._matrix is None or self._matrix.shape[0] < needed_rows:
+            row_count = os.path.getsize(self.vectors_path) // (self.dim * 4)
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(row_count, self.dim))
+        return self._matrix
+
+    def get_many(self, keys):
+        with self._lock:
+            if any(key not in self.rows for key in keys):
+                self._read_keys()
+            found = [key for key in keys if key in self.rows]
+            if not found:
+                return {}
+            vectors = self._vectors(max(self.rows[key] for key in found) + 1)
+            return {key: vectors[self.rows[key]].tolist() for key in found}
+
+    def put_many(self, items):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.lock_path, 'a') as lock_file:
+                if fcntl is not None:
+                    # Released when the file is closed
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._append(items)
+
+    def _append(self, items):
+        self._read_keys()
+        items = {key: vector for key, vector in items.items() if key not in self.rows}
+        if not items:
+            return
+        matrix = np.asarray(list(items.values()), dtype=np.float32)
+        if self.dim is not None and matrix.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match the cache ({self.dim})")
+        row_bytes = matrix.shape[1] * 4
+
+        with open(self.vectors_path, 'ab') as f:
+            end = f.seek(0, os.SEEK_END)
+            if end % row_bytes:
+                # A row cut short by a crash
+                end -= end % row_bytes
+                f.truncate(end)
+            first_row = end // row_bytes
+            f.write(matrix.tobytes())
+
+        lines = [] if self.dim is not None else [json.dumps({"dim": matrix.shape[1]})]
+        lines.extend(json.dumps([key, first_row + i]) for i, key in enumerate(items))
+        with open(self.keys_path, 'ab+') as f:
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # Terminate a line cut short by a crash, it is skipped on read
+                    f.write(b"\n")
+            f.write(("\n".join(lines) + "\n").encode('utf-8'))
+        self._read_keys()
+
+
+class CachedEmbedding(BaseEmbedding):
+    # Wraps an embedding model and only embeds chunks it has not seen before
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _store: EmbeddingStore = PrivateAttr()
+
+    def __init__(self, inner, store, **kwargs: Any):
+        super().__init__(model_name=inner.model_name, embed_batch_size=inner.embed_batch_size, **kwargs)
+        self._inner = inner
+        self._store = store
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._inner.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._inner.aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        embeddings = self._store.get_many(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in embeddings:
+                missing[key] = text
+        if missing:
+            vectors = self._inner.get_text_embedding_batch(list(missing.values()))
+            computed = dict(zip(missing, vectors))
+            self._store.put_many(computed)
+            embeddings.update(computed)
+        return [embeddings[key] for key in keys]
+
+
+class SentenceTransformerEmbedding(BaseEmbedding):
+    # Local CPU embeddings with batched encoding, no API calls
+
+    _model: Any = PrivateAttr()
+
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2", embed_batch_size=64, device="cpu", **kwargs: Any):
+        super().__init__(model_name=model_name, embed_batch_size=embed_batch_size, **kwargs)
+        from sentence_transformers import SentenceTransformer
+
+        self._model = SentenceTransformer(model_name, device=device)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SentenceTransformerEmbedding"
+
+    def _encode(self, texts):
+        return self._model.encode(
+            texts,
+            batch_size=self.embed_batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        ).tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._encode([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts)
+
+
+def create_embed_model():
+    backend = os.getenv("EMBEDDING_BACKEND", "openai")
+    if backend == "local":
+        embed_model = SentenceTransformerEmbedding(
+            model_name=os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2"),
+            embed_batch_size=int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", 64)),
+        )
+    elif backend == "openai":
+        from llama_index.embeddings.openai import OpenAIEmbedding
+
+        embed_model = OpenAIEmbedding(**http_clients.openai_kwargs())
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+
+    if os.getenv("EMBEDDING_CACHE", "1") == "1":
+        embed_model = CachedEmbedding(embed_model, EmbeddingStore())
+    return embed_model
@@ -0,0 +1,36 @@
+import gc
+import os
+
+# Pre-fork serving: the master imports the app and loads the document index,
+# page store and TF-IDF page index once, then forks the workers, which share
+# those pages copy-on-write (the page store and TF-IDF matrix are memory-mapped
+# files, so they stay shared). Run from this directory with
+#   gunicorn -c gunicorn.conf.py app:app
+# and see per-worker Rss/Pss with `python process_memory.py` or /admin/memory.
+bind = os.getenv("BIND", "127.0.0.1:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", 4))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 8))
+timeout = int(os.getenv("WEB_TIMEOUT", 120))
+pidfile = os.getenv("GUNICORN_PIDFILE", "./gunicorn.pid")
+preload_app = True
+
+
+def on_starting(server):
+    # No collections while loading: a collection touches every object header
+    # and the pages it dirties would no longer be shared after fork
+    gc.disable()
+
+
+def when_ready(server):
+    # Runs in the master after the app was imported and before any worker forks
+    import app
+
+    app.preload()
+    # Move everything loaded so far out of the collector's reach, so the
+    # workers' collections don't write to (and copy) the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
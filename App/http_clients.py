@@ -0,0 +1,61 @@
+import functools
+import os
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 100))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_KEEPALIVE_CONNECTIONS", 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", 30))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", 60))
+
+
+def _pool_options():
+    import httpx
+
+    return {
+        "limits": httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+    }
+
+
+# One keep-alive connection pool per process for every OpenAI LLM and
+# embedding client, instead of one per client object
+@functools.lru_cache(maxsize=None)
+def sync_client():
+    import httpx
+
+    return httpx.Client(**_pool_options())
+
+
+@functools.lru_cache(maxsize=None)
+def async_client():
+    import httpx
+
+    return httpx.AsyncClient(**_pool_options())
+
+
+def openai_kwargs():
+    return {"http_client": sync_client(), "async_http_client": async_client()}
+
+
+async def aclose():
+    if async_client.cache_info().currsize:
+        await async_client().aclose()
+        async_client.cache_clear()
+
+
+def _drop_inherited_connections():
+    # After fork the child would share the parent's pooled keep-alive sockets;
+    # forget them (without closing, the parent still uses them) so the child
+    # opens its own. The clients are kept, LLM objects already reference them.
+    for factory in (sync_client, async_client):
+        if factory.cache_info().currsize:
+            pool = getattr(factory()._transport, "_pool", None)
+            if pool is not None:
+                pool._connections = []
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_drop_inherited_connections)
@@ -0,0 +1,274 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+
+import embeddings
+import http_clients
+import page_store
+import startup
+import telemetry
+from llama_index.core import (
+    Document,
+    ServiceContext,
+    Settings,
+    SimpleDirectoryReader,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.utils import get_tokenizer
+from llama_index.llms.openai import OpenAI
+
+pdf_dir = page_store.pdf_dir
+scan_data_dir = page_store.scan_data_dir
+persist_dir = os.getenv("INDEX_PERSIST_DIR", "./storage")
+MANIFEST_FILE = "manifest.json"
+
+_index = None
+_manifest = None
+_version = None
+_index_lock = threading.Lock()
+
+
+def _field(obj, name):
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+class TelemetryCallbackHandler(BaseCallbackHandler):
+    # Times retrieval, embedding and LLM calls as request stages and counts LLM
+    # tokens; streamed responses carry no usage, so those are counted locally
+    STAGES = {
+        CBEventType.RETRIEVE: "retrieval",
+        CBEventType.EMBEDDING: "embedding",
+        CBEventType.LLM: "llm",
+    }
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._started = {}
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        if event_type in self.STAGES:
+            self._started[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        started = self._started.pop(event_id, None)
+        if started is not None:
+            telemetry.observe_stage(self.STAGES[event_type], time.perf_counter() - started)
+        if event_type == CBEventType.LLM and payload:
+            self._count_tokens(payload)
+
+    def _count_tokens(self, payload):
+        response = payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION)
+        usage = _field(_field(response, "raw"), "usage")
+        if usage:
+            telemetry.add_tokens("prompt", _field(usage, "prompt_tokens"))
+            telemetry.add_tokens("completion", _field(usage, "completion_tokens"))
+            return
+        tokenizer = get_tokenizer()
+        messages = payload.get(EventPayload.MESSAGES)
+        prompt = "\n".join(str(message.content) for message in messages) if messages else payload.get(EventPayload.PROMPT)
+        message = _field(response, "message")
+        completion = message.content if message is not None else _field(response, "text")
+        telemetry.add_tokens("prompt", len(tokenizer(prompt or "")))
+        telemetry.add_tokens("completion", len(tokenizer(completion or "")))
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def callback_manager():
+    # Also the default: chat and query engines set their LLM's manager to the
+    # one from Settings, which would otherwise drop the handler
+    manager = CallbackManager([TelemetryCallbackHandler()])
+    Settings.callback_manager = manager
+    return manager
+
+
+@functools.lru_cache(maxsize=None)
+def service_context():
+    llm = OpenAI(model="gpt-3.5-turbo", temperature="0.1", systemprompt="""Use the books in data file as source for the answer. Generate a valid
+                 and relevant answer to a query related to
+                 construction problems, ensure the answer is based strictly on the content of
+                 the book and not influenced by other sources. Do not hallucinate. The answer should
+                 be informative and fact-based. """, **http_clients.openai_kwargs())
+    return ServiceContext.from_defaults(llm=llm, embed_model=embeddings.create_embed_model(), callback_manager=callback_manager())
+
+
+def embed_model_name():
+    return service_context().embed_model.model_name
+
+
+def _fresh_page_store(current):
+    # The page store must match the files being indexed
+    store = page_store.get_page_store()
+    pdfs = {path: digest for path, digest in current.items() if path.endswith(".pdf")}
+    if store.files != pdfs:
+        store = page_store.reingest()
+    return store
+
+
+def _load_file_documents(path, store):
+    if not path.endswith(".pdf"):
+        return SimpleDirectoryReader(input_files=[path], filename_as_id=True).load_data()
+    # Same ids and metadata as SimpleDirectoryReader's PDF reader, from the page store
+    return [
+        Document(
+            text=text,
+            id_=f"{path}_part_{page - 1}",
+            metadata={"page_label": str(page), "file_name": os.path.basename(path), "file_path": path},
+            excluded_embed_metadata_keys=["file_path"],
+            excluded_llm_metadata_keys=["file_path"],
+        )
+        for _, page, text in store.iter_pages(path)
+    ]
+
+
+def _manifest_path(index_dir):
+    return os.path.join(index_dir, MANIFEST_FILE)
+
+
+def _persist(index, manifest, index_dir):
+    index.storage_context.persist(persist_dir=index_dir)
+    tmp_path = _manifest_path(index_dir) + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"embed_model": embed_model_name(), "files": manifest}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, _manifest_path(index_dir))
+
+
+def build_index(data_dir=pdf_dir, index_dir=persist_dir):
+    manifest = {}
+    documents = []
+    current = scan_data_dir(data_dir)
+    store = _fresh_page_store(current)
+    for path, digest in sorted(current.items()):
+        file_docs = _load_file_documents(path, store)
+        manifest[path] = {"sha256": digest, "doc_ids": [doc.doc_id for doc in file_docs]}
+        documents.extend(file_docs)
+
+    index = VectorStoreIndex.from_documents(documents, service_context=service_context())
+    _persist(index, manifest, index_dir)
+    print(f"Index built from {len(manifest)} files ({len(documents)} documents).")
+    return index, manifest
+
+
+def load_index(index_dir=persist_dir):
+    if not os.path.exists(_manifest_path(index_dir)):
+        return None, None
+    with open(_manifest_path(index_dir)) as f:
+        meta = json.load(f)
+    # Vectors from another embedding model can't be mixed in, rebuild instead
+    if meta.get("embed_model") != embed_model_name():
+        print(f"Index was built with embedding model {meta.get('embed_model')}, rebuilding.")
+        return None, None
+    manifest = meta["files"]
+    storage_context = StorageContext.from_defaults(persist_dir=index_dir)
+    index = load_index_from_storage(storage_context, service_context=service_context())
+    return index, manifest
+
+
+def refresh_index(index, manifest, data_dir=pdf_dir, index_dir=persist_dir):
+    # Re-embed only the files whose content hash changed since the last persist
+    current = scan_data_dir(data_dir)
+    store = None
+    changed = []
+
+    for path in sorted(set(manifest) - set(current)):
+        for doc_id in manifest.pop(path)["doc_ids"]:
+            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        changed.append(path)
+
+    for path, digest in sorted(current.items()):
+        entry = manifest.get(path)
+        if entry and entry["sha256"] == digest:
+            continue
+        if entry:
+            for doc_id in entry["doc_ids"]:
+                index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        store = store or _fresh_page_store(current)
+        file_docs = _load_file_documents(path, store)
+        for doc in file_docs:
+            index.insert(doc)
+        manifest[path] = {"sha256": digest, "doc_ids": [doc.doc_id for doc in file_docs]}
+        changed.append(path)
+
+    if changed:
+        _persist(index, manifest, index_dir)
+        print(f"Index refreshed, re-embedded {len(changed)} changed files.")
+    return changed
+
+
+def embed_model():
+    return service_context().embed_model
+
+
+def manifest_version(manifest):
+    digest = hashlib.sha256(embed_model_name().encode('utf-8'))
+    for path, entry in sorted(manifest.items()):
+        digest.update(f"{path}:{entry['sha256']}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def index_version():
+    # Changes whenever the set or content of indexed files changes
+    return _version
+
+
+def get_index():
+    global _index, _manifest, _version
+    if _index is not None:
+        return _index
+    with _index_lock:
+        if _index is None:
+            with startup.timed("load document index"):
+                index, manifest = load_index()
+                if index is None:
+                    index, manifest = build_index()
+                else:
+                    refresh_index(index, manifest)
+            _index, _manifest = index, manifest
+            _version = manifest_version(manifest)
+    return _index
+
+
+def refresh():
+    global _version
+    if _index is None:
+        get_index()
+        return []
+    with _index_lock:
+        changed = refresh_index(_index, _manifest)
+        _version = manifest_version(_manifest)
+    return changed
+
+
+def rebuild():
+    global _index, _manifest, _version
+    with _index_lock:
+        _index, _manifest = build_index()
+        _version = manifest_version(_manifest)
+    return _index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the persisted document index.")
+    parser.add_argument("command", choices=["rebuild", "refresh"])
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild()
+    else:
+        refresh()
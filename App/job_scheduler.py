@@ -0,0 +1,364 @@
+import itertools
+import math
+import os
+import threading
+import time
+import uuid
+
+import telemetry
+
+log = telemetry.get_logger("jobs")
+
+JOBS = telemetry.counter("jobs_total", "Jobs by outcome.", ("outcome",))
+JOB_QUEUE_WAIT = telemetry.histogram("job_queue_wait_seconds", "Time from submission until a worker started the job.", ("priority",))
+JOB_RUN = telemetry.histogram("job_run_seconds", "Time a worker spent running a job.")
+
+FINISHED = ("done", "failed")
+
+
+class QueueFull(Exception):
+    # The job wasn't admitted; retrying after retry_after seconds likely succeeds
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Job:
+    __slots__ = ("id", "user_id", "priority", "state", "coalesced", "info", "result", "error",
+                 "created", "finished", "on_done", "key", "slot", "work")
+
+    def __init__(self, user_id, priority, key, slot):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.priority = priority
+        self.state = "reserved"
+        self.coalesced = False
+        self.info = {}
+        self.result = None
+        self.error = None
+        self.created = time.monotonic()
+        self.finished = None
+        self.on_done = None
+        self.key = key
+        self.slot = slot  # holds a place in the queue until it is started
+        self.work = None  # for a job without a slot, the work it coalesces onto
+
+
+class _Work:
+    # One run of a job function, shared by every job coalesced onto it. The
+    # events it emits are kept so a job attached later still sees all of them.
+    __slots__ = ("fn", "trace", "key", "user_id", "priority", "seq", "queued_at", "started_at",
+                 "jobs", "events", "changed", "done", "result", "error")
+
+    def __init__(self, fn, key, user_id, priority, seq, lock):
+        self.fn = fn
+        self.trace = telemetry.current()
+        self.key = key
+        self.user_id = user_id
+        self.priority = priority
+        self.seq = seq
+        self.queued_at = time.monotonic()
+        self.started_at = None
+        self.jobs = []
+        self.events = []
+        self.changed = threading.Condition(lock)
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def emit(self, event, data):
+        with self.changed:
+            self.events.append((event, data))
+            self.changed.notify_all()
+
+
+class JobScheduler:
+    # Runs jobs on a fixed pool of worker threads from a bounded queue. Lower
+    # priority values go first, except that a job queued longer than
+    # max_priority_wait goes before everything else so no tier starves. Each
+    # user has at most per_user_limit jobs in flight and max_running_per_user
+    # of them running. A job reserved with the key of a queued or running one
+    # shares that run instead of making its own upstream calls.
+
+    def __init__(self, workers=8, max_queued=100, per_user_limit=2, max_running_per_user=1,
+                 max_priority_wait=30.0, job_ttl=600):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.per_user_limit = per_user_limit
+        self.max_running_per_user = max_running_per_user
+        self.max_priority_wait = max_priority_wait
+        self.job_ttl = job_ttl
+        self.coalesced = 0
+        self.rejected = 0
+        self._jobs = {}  # id -> job, finished jobs stay job_ttl for polling
+        self._queue = []  # queued works, oldest first
+        self._inflight = {}  # key -> queued or running work
+        self._user_jobs = {}  # user_id -> unfinished jobs
+        self._running_users = {}  # user_id -> running works
+        self._reserved = 0
+        self._running = 0
+        self._avg_run = 5.0
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._work_ready = threading.Condition(self._lock)
+        self._pid = None
+
+    def ensure_started(self):
+        # Threads don't survive fork, so each worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True).start()
+
+    def _retry_after(self, ahead):
+        # Seconds until `ahead` queued works have likely gone through the workers
+        return max(1, min(60, math.ceil((ahead / self.workers + 1) * self._avg_run)))
+
+    def reserve(self, user_id, priority, key=None):
+        # Admits a job or raises QueueFull. A job that will coalesce onto an
+        # in-flight one takes no place in the queue.
+        self.ensure_started()
+        with self._lock:
+            self._expire()
+            in_flight = self._user_jobs.get(user_id, 0)
+            if in_flight >= self.per_user_limit:
+                self.rejected += 1
+                JOBS.inc("rejected")
+                raise QueueFull("Too many questions in progress, wait for an answer first", self._retry_after(0))
+            if in_flight:
+                # The user's earlier job may change what this one should
+                # answer (e.g. conversation history), so it runs on its own
+                key = None
+            work = self._inflight.get(key) if key is not None else None
+            slot = work is None
+            if slot and len(self._queue) + self._reserved >= self.max_queued:
+                self.rejected += 1
+                JOBS.inc("rejected")
+                raise QueueFull("Too many questions right now, try again shortly", self._retry_after(len(self._queue)))
+            job = Job(user_id, priority, key, slot)
+            if slot:
+                self._reserved += 1
+            else:
+                # Started onto this work even if it finishes first, so the job
+                # never needs the place in the queue it wasn't given
+                job.work = work
+            self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+            self._jobs[job.id] = job
+            return job
+
+    def cancel(self, job):
+        # Gives up a reservation that won't be started
+        with self._lock:
+            if job.state != "reserved":
+                return
+            self._release(job)
+            self._jobs.pop(job.id, None)
+            job.state = "cancelled"
+
+    def _release(self, job):
+        if job.slot:
+            self._reserved -= 1
+            job.slot = False
+        remaining = self._user_jobs.get(job.user_id, 0) - 1
+        if remaining > 0:
+            self._user_jobs[job.user_id] = remaining
+        else:
+            self._user_jobs.pop(job.user_id, None)
+
+    def start(self, job, fn, on_done=None, info=None):
+        # Queues fn(emit) for a reserved job, under the caller's trace. Once the
+        # work is done, on_done(job, result) runs for each job sharing it and
+        # its return value is the job's result.
+        with self._lock:
+            job.on_done = on_done
+            job.info = info or {}
+            key = job.key
+            if job.slot:
+                self._reserved -= 1
+                job.slot = False
+                work = self._inflight.get(key) if key is not None else None
+            else:
+                work = job.work
+            if work is not None:
+                job.coalesced = True
+                self.coalesced += 1
+                JOBS.inc("coalesced")
+            else:
+                work = _Work(fn, key, job.user_id, job.priority, next(self._seq), self._lock)
+                self._queue.append(work)
+                if key is not None:
+                    self._inflight[key] = work
+                self._work_ready.notify()
+                self._queue_changed()
+            JOBS.inc("started")
+            job.work = work
+            job.state = "queued" if work.started_at is None else "running"
+            if not work.done:
+                work.jobs.append(job)
+                return job
+        # The work finished between reserve and start
+        self._complete(job, work.result, work.error)
+        return job
+
+    def _next(self):
+        # Oldest work past max_priority_wait, else the oldest of the best priority;
+        # works of users already at their running limit wait
+        now = time.monotonic()
+        best = None
+        for work in self._queue:
+            if self._running_users.get(work.user_id, 0) >= self.max_running_per_user:
+                continue
+            if now - work.queued_at > self.max_priority_wait:
+                return work
+            if best is None or work.priority < best.priority:
+                best = work
+        return best
+
+    def _queue_changed(self):
+        # Wakes event streams of queued jobs, whose position may have moved
+        for work in self._queue:
+            work.changed.notify_all()
+
+    def _position(self, work):
+        return sum(1 for other in self._queue if (other.priority, other.seq) < (work.priority, work.seq))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                work = self._next()
+                while work is None:
+                    self._work_ready.wait()
+                    work = self._next()
+                self._queue.remove(work)
+                work.started_at = time.monotonic()
+                self._running += 1
+                self._running_users[work.user_id] = self._running_users.get(work.user_id, 0) + 1
+                for job in work.jobs:
+                    job.state = "running"
+                work.changed.notify_all()
+                self._queue_changed()
+            JOB_QUEUE_WAIT.observe(work.started_at - work.queued_at, str(work.priority))
+
+            try:
+                result, error = telemetry.run_with_trace(work.trace, work.fn, work.emit), None
+            except Exception as e:
+                log.warning("Job failed", exc_info=True, extra={"fields": {"jobs": len(work.jobs)}})
+                result, error = None, e
+            self._finish(work, result, error)
+
+    def _finish(self, work, result, error):
+        run_seconds = time.monotonic() - work.started_at
+        JOB_RUN.observe(run_seconds)
+        with self._lock:
+            work.done = True
+            work.result = result
+            work.error = error
+            if work.key is not None and self._inflight.get(work.key) is work:
+                del self._inflight[work.key]
+            self._running -= 1
+            running = self._running_users[work.user_id] - 1
+            if running:
+                self._running_users[work.user_id] = running
+            else:
+                del self._running_users[work.user_id]
+            self._avg_run = 0.8 * self._avg_run + 0.2 * run_seconds
+            # The user's next work may be runnable now
+            self._work_ready.notify()
+            jobs = list(work.jobs)
+
+        for job in jobs:
+            self._complete(job, result, error)
+
+    def _complete(self, job, result, error):
+        if error is None and job.on_done is not None:
+            try:
+                result = job.on_done(job, result)
+            except Exception as e:
+                log.warning("Job completion failed", exc_info=True)
+                result, error = None, e
+        with self._lock:
+            job.result = result
+            job.error = error
+            job.state = "failed" if error is not None else "done"
+            job.finished = time.monotonic()
+            self._release(job)
+            job.work.changed.notify_all()
+        JOBS.inc(job.state)
+
+    def _expire(self):
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished is not None and now - job.finished > self.job_ttl:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job, timeout=None):
+        # True once the job finished, False if it is still going after timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while job.state not in FINISHED:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                job.work.changed.wait(remaining)
+            return True
+
+    def events(self, job, timeout=None):
+        # Yields ("queued", {"position": n}) whenever the job's place in the
+        # queue changes, then the events of its work as they are emitted,
+        # including earlier ones. Ends when the job finished or after timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        sent = 0
+        last_position = None
+        while True:
+            with self._lock:
+                work = job.work
+                while True:
+                    new_events = work.events[sent:]
+                    position = self._position(work) if work.started_at is None else None
+                    finished = job.state in FINISHED
+                    if new_events or finished or position != last_position:
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return
+                    work.changed.wait(remaining)
+            if position is not None and position != last_position:
+                yield "queued", {"position": position}
+            last_position = position
+            yield from new_events
+            sent += len(new_events)
+            if finished:
+                return
+
+    def status(self, job):
+        with self._lock:
+            status = {"job_id": job.id, "state": job.state, "coalesced": job.coalesced, **job.info}
+            if job.state == "queued":
+                status["position"] = self._position(job.work)
+            elif job.state == "done":
+                status["result"] = job.result
+            return status
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": len(self._queue),
+                "reserved": self._reserved,
+                "running": self._running,
+                "max_queued": self.max_queued,
+                "per_user_limit": self.per_user_limit,
+                "max_running_per_user": self.max_running_per_user,
+                "tracked_jobs": len(self._jobs),
+                "coalesced": self.coalesced,
+                "rejected": self.rejected,
+                "avg_run_seconds": round(self._avg_run, 2),
+            }
@@ -0,0 +1,139 @@
+import json
+import os
+import pickle
+import threading
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import page_store
+import startup
+
+page_index_dir = os.path.join(os.getenv("INDEX_PERSIST_DIR", "./storage"), "page_index")
+
+MATRIX_PARTS = ("data", "indices", "indptr")
+
+_page_index = None
+_page_index_lock = threading.Lock()
+
+
+def _replace(path, write, mode='wb'):
+    # Write next to the target and rename over it, so processes that still
+    # have the old file memory-mapped keep reading the old inode
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, mode) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class PageIndex:
+    # One TF-IDF vectorizer fitted over every PDF page, rows are L2-normalised.
+    # Page texts themselves stay in the page store.
+
+    def __init__(self, vectorizer, matrix, pages, fingerprint):
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.pages = pages
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, store):
+        pages = []
+        texts = []
+        for path, page, text in store.iter_pages():
+            pages.append((path, page))
+            texts.append(text)
+
+        vectorizer = TfidfVectorizer()
+        if pages:
+            matrix = vectorizer.fit_transform(texts).tocsr()
+        else:
+            matrix = sparse.csr_matrix((0, 0))
+        return cls(vectorizer, matrix, pages, store.fingerprint)
+
+    def save(self, directory=page_index_dir):
+        # The CSR arrays go in plain .npy files so load() can memory-map them;
+        # pages.json is written last and marks the index complete
+        os.makedirs(directory, exist_ok=True)
+        for part in MATRIX_PARTS:
+            array = getattr(self.matrix, part)
+            _replace(os.path.join(directory, f"tfidf.{part}.npy"), lambda f: np.save(f, array))
+        _replace(os.path.join(directory, "vectorizer.pkl"), lambda f: pickle.dump(self.vectorizer, f))
+        meta = {"fingerprint": self.fingerprint, "shape": list(self.matrix.shape), "pages": self.pages}
+        _replace(os.path.join(directory, "pages.json"), lambda f: json.dump(meta, f), mode='w')
+
+    @classmethod
+    def load(cls, directory=page_index_dir):
+        # The matrix is read through memory maps, so every process serving the
+        # same index shares one copy in the page cache
+        with open(os.path.join(directory, "pages.json")) as f:
+            meta = json.load(f)
+        if "shape" not in meta:
+            # Saved in the old single-file format, rebuild
+            return None
+        with open(os.path.join(directory, "vectorizer.pkl"), 'rb') as f:
+            vectorizer = pickle.load(f)
+        shape = tuple(meta["shape"])
+        if shape[0]:
+            arrays = tuple(np.load(os.path.join(directory, f"tfidf.{part}.npy"), mmap_mode='r') for part in MATRIX_PARTS)
+            matrix = sparse.csr_matrix(arrays, shape=shape, copy=False)
+        else:
+            matrix = sparse.csr_matrix(shape)
+        return cls(vectorizer, matrix, [tuple(page) for page in meta["pages"]], meta["fingerprint"])
+
+    def search(self, text, store, top_k=3):
+        # Best page score is the max cosine similarity over the text's paragraphs
+        paragraphs = [p for p in text.split("\n\n") if p.strip()]
+        if not paragraphs or not self.pages:
+            return []
+
+        query = self.vectorizer.transform(paragraphs)
+        scores = (self.matrix @ query.T).toarray().max(axis=1)
+
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        sections = []
+        for i in top:
+            if scores[i] <= 0:
+                continue
+            path, page = self.pages[i]
+            sections.append({
+                "pdf": os.path.relpath(path, page_store.pdf_dir),
+                "page": page,
+                "score": float(scores[i]),
+                "text": store.text(path, page),
+            })
+        return sections
+
+
+def get_page_index():
+    global _page_index
+    if _page_index is not None:
+        return _page_index
+    with _page_index_lock:
+        if _page_index is None:
+            store = page_store.get_page_store()
+            with startup.timed("load page index"):
+                page_index = None
+                if os.path.exists(os.path.join(page_index_dir, "pages.json")):
+                    page_index = PageIndex.load()
+                if page_index is None or page_index.fingerprint != store.fingerprint:
+                    PageIndex.build(store).save()
+                    # Serve the memory-mapped copy rather than the one just built
+                    page_index = PageIndex.load()
+            _page_index = page_index
+    return _page_index
+
+
+def rebuild():
+    global _page_index
+    with _page_index_lock:
+        PageIndex.build(page_store.reingest()).save()
+        _page_index = PageIndex.load()
+    return _page_index
+
+
+def search(text, top_k=3):
+    return get_page_index().search(text, page_store.get_page_store(), top_k=top_k)
@@ -0,0 +1,190 @@
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import startup
+
+pdf_dir = "./data"
+page_store_dir = os.path.join(os.getenv("INDEX_PERSIST_DIR", "./storage"), "pages")
+BLOB_FILE = "pages.bin"
+TABLE_FILE = "pages.json"
+PAGES_PER_TASK = 32
+
+_page_store = None
+_page_store_lock = threading.Lock()
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_data_dir(data_dir=pdf_dir):
+    # Content hash of every (non-hidden) file in the data directory
+    hashes = {}
+    for root, dirs, files in os.walk(data_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            hashes[path] = file_hash(path)
+    return hashes
+
+
+def _extract_pages(task):
+    # Runs in a worker process
+    import fitz
+
+    path, start, stop = task
+    with fitz.open(path) as doc:
+        return [doc.load_page(page_num).get_text("text") for page_num in range(start, stop)]
+
+
+def _page_count(path):
+    import fitz
+
+    with fitz.open(path) as doc:
+        return doc.page_count
+
+
+class PageStore:
+    # Page texts of every PDF in one contiguous UTF-8 blob, memory-mapped, with
+    # a (pdf, page) -> (offset, length) table
+
+    def __init__(self, directory, files, pages):
+        self.directory = directory
+        self.files = files
+        self.pages = pages
+        self._positions = {(pdf, page): i for i, (pdf, page, _, _) in enumerate(pages)}
+        self._blob = None
+        blob_path = os.path.join(directory, BLOB_FILE)
+        if os.path.getsize(blob_path):
+            with open(blob_path, 'rb') as f:
+                self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def open(cls, directory=page_store_dir):
+        table_path = os.path.join(directory, TABLE_FILE)
+        if not os.path.exists(table_path):
+            return None
+        with open(table_path) as f:
+            table = json.load(f)
+        return cls(directory, table["files"], [tuple(page) for page in table["pages"]])
+
+    @property
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        for path, file_digest in sorted(self.files.items()):
+            digest.update(f"{path}:{file_digest}\n".encode('utf-8'))
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self.pages)
+
+    def _text_at(self, i):
+        _, _, offset, length = self.pages[i]
+        if not length:
+            return ""
+        return self._blob[offset:offset + length].decode('utf-8')
+
+    def text(self, pdf, page):
+        return self._text_at(self._positions[(pdf, page)])
+
+    def iter_pages(self, pdf=None):
+        # Yields (pdf, page, text), page numbers start at 1
+        for i, (page_pdf, page, _, _) in enumerate(self.pages):
+            if pdf is None or page_pdf == pdf:
+                yield page_pdf, page, self._text_at(i)
+
+    def close(self):
+        if self._blob is not None:
+            self._blob.close()
+            self._blob = None
+
+
+def ingest(data_dir=pdf_dir, directory=page_store_dir, workers=None):
+    # Extracts every changed PDF across a process pool; unchanged files are
+    # copied over from the previous store without being parsed again
+    current = {path: digest for path, digest in scan_data_dir(data_dir).items() if path.endswith(".pdf")}
+    previous = PageStore.open(directory)
+
+    texts = {}
+    tasks = []
+    for path, digest in sorted(current.items()):
+        if previous is not None and previous.files.get(path) == digest:
+            texts[path] = [text for _, _, text in previous.iter_pages(path)]
+            continue
+        page_count = _page_count(path)
+        texts[path] = [None] * page_count
+        tasks.extend((path, start, min(start + PAGES_PER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_TASK))
+
+    if tasks:
+        workers = workers or int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+        if workers > 1 and len(tasks) > 1:
+            context = multiprocessing.get_context(os.getenv("INGEST_START_METHOD", "spawn"))
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=context) as executor:
+                results = list(executor.map(_extract_pages, tasks))
+        else:
+            results = [_extract_pages(task) for task in tasks]
+        for (path, start, stop), page_texts in zip(tasks, results):
+            texts[path][start:stop] = page_texts
+
+    os.makedirs(directory, exist_ok=True)
+    pages = []
+    offset = 0
+    blob_path = os.path.join(directory, BLOB_FILE)
+    with open(blob_path + ".tmp", 'wb') as blob:
+        for path in sorted(texts):
+            for page_num, text in enumerate(texts[path]):
+                data = text.encode('utf-8')
+                blob.write(data)
+                pages.append((path, page_num + 1, offset, len(data)))
+                offset += len(data)
+    table_path = os.path.join(directory, TABLE_FILE)
+    with open(table_path + ".tmp", 'w') as f:
+        json.dump({"files": current, "pages": pages}, f)
+
+    if previous is not None:
+        previous.close()
+    os.replace(blob_path + ".tmp", blob_path)
+    os.replace(table_path + ".tmp", table_path)
+    print(f"Ingested {len(current)} PDFs ({len(pages)} pages), parsed {len(tasks)} page ranges.")
+    return PageStore.open(directory)
+
+
+def get_page_store():
+    global _page_store
+    if _page_store is not None:
+        return _page_store
+    with _page_store_lock:
+        if _page_store is None:
+            with startup.timed("load page store"):
+                current = {path: digest for path, digest in scan_data_dir().items() if path.endswith(".pdf")}
+                page_store = PageStore.open()
+                if page_store is None or page_store.files != current:
+                    page_store = ingest()
+            _page_store = page_store
+    return _page_store
+
+
+def reingest():
+    global _page_store
+    with _page_store_lock:
+        _page_store = ingest()
+    return _page_store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract the PDF corpus into the page-text store.")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    ingest(workers=args.workers)
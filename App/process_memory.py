@@ -0,0 +1,89 @@
+import argparse
+import os
+
+SMAPS_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty", "Swap")
+
+
+def smaps_rollup(pid="self"):
+    # Memory totals in MB from /proc/<pid>/smaps_rollup (Linux 4.14+). Pss
+    # charges each shared page to the processes sharing it in equal parts, so
+    # summing Pss over workers gives their real footprint where Rss overcounts.
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if name in SMAPS_FIELDS:
+                values[name.lower() + "_mb"] = round(int(rest.split()[0]) / 1024, 1)
+    return values
+
+
+def report(pid=None):
+    pid = os.getpid() if pid is None else int(pid)
+    usage = smaps_rollup(pid)
+    usage["pid"] = pid
+    usage["shared_mb"] = round(usage.get("shared_clean_mb", 0) + usage.get("shared_dirty_mb", 0), 1)
+    usage["private_mb"] = round(usage.get("private_clean_mb", 0) + usage.get("private_dirty_mb", 0), 1)
+    return usage
+
+
+def children(pid):
+    pid = int(pid)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        # Kernel built without CONFIG_PROC_CHILDREN: scan every process's parent
+        found = []
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    # The command name may contain spaces, the fields after it don't
+                    ppid = int(f.read().rpartition(")")[2].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            if ppid == pid:
+                found.append(int(entry))
+        return sorted(found)
+
+
+def tree_report(master_pid):
+    # A pre-fork master and its workers; processes that exit meanwhile (or that
+    # belong to another user) are skipped
+    processes = []
+    for pid in [int(master_pid)] + children(master_pid):
+        try:
+            processes.append(report(pid))
+        except OSError:
+            continue
+    total_rss = round(sum(p.get("rss_mb", 0) for p in processes), 1)
+    total_pss = round(sum(p.get("pss_mb", 0) for p in processes), 1)
+    return {
+        "processes": processes,
+        "total_rss_mb": total_rss,
+        "total_pss_mb": total_pss,
+        "shared_savings_mb": round(total_rss - total_pss, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report RSS and PSS of a pre-fork server and its workers.")
+    parser.add_argument("pid", nargs="?", help="master pid (default: read from --pidfile)")
+    parser.add_argument("--pidfile", default=os.getenv("GUNICORN_PIDFILE", "./gunicorn.pid"))
+    args = parser.parse_args()
+
+    pid = args.pid
+    if pid is None:
+        with open(args.pidfile) as f:
+            pid = f.read().strip()
+    tree = tree_report(pid)
+    print(f"{'pid':>8} {'rss MB':>9} {'pss MB':>9} {'shared MB':>10} {'private MB':>11}")
+    for p in tree["processes"]:
+        print(f"{p['pid']:>8} {p.get('rss_mb', 0):>9} {p.get('pss_mb', 0):>9} {p['shared_mb']:>10} {p['private_mb']:>11}")
+    print(f"{'total':>8} {tree['total_rss_mb']:>9} {tree['total_pss_mb']:>9}")
+    print(f"Summed Rss counts shared pages once per process, overstating the total by {tree['shared_savings_mb']} MB.")
+
+
+if __name__ == "__main__":
+    main()
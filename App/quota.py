@@ -0,0 +1,96 @@
+import os
+from datetime import datetime
+
+from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+QUESTION_LIMITS = {
+    "basic": int(os.getenv("QUESTION_LIMIT_BASIC", 5)),
+    "pro": int(os.getenv("QUESTION_LIMIT_PRO", 10)),
+}
+DEFAULT_TIER = "basic"
+
+_deserializer = TypeDeserializer()
+
+
+class QuotaResult:
+    __slots__ = ("allowed", "remaining", "limit", "user_type", "error", "user")
+
+    def __init__(self, allowed, remaining=0, limit=0, user_type=None, error=None, user=None):
+        self.allowed = allowed
+        self.remaining = remaining
+        self.limit = limit
+        self.user_type = user_type
+        self.error = error
+        self.user = user
+
+
+def limit_for(user_type, limits=QUESTION_LIMITS):
+    return limits.get(user_type, limits[DEFAULT_TIER])
+
+
+def _under_limit(limits):
+    # question_count is below the limit of the user's tier, unknown tiers use the default
+    condition = None
+    for tier, limit in limits.items():
+        clause = Attr('user_type').eq(tier) & Attr('question_count').lt(limit)
+        condition = clause if condition is None else condition | clause
+    other_tier = Attr('user_type').not_exists() | ~Attr('user_type').is_in(list(limits))
+    return condition | (other_tier & Attr('question_count').lt(limits[DEFAULT_TIER]))
+
+
+def _allowed(user, limits):
+    user_type = user.get('user_type', DEFAULT_TIER)
+    limit = limit_for(user_type, limits)
+    return QuotaResult(True, max(0, limit - int(user['question_count'])), limit, user_type, user=user)
+
+
+def consume_question(table, user_id, limits=QUESTION_LIMITS, today=None, retry=True):
+    # Counts one question against today's quota. Same-day questions are a single
+    # conditional UpdateItem covering the limit check and the increment; only the
+    # first question of a new day needs a second one to reset the counter.
+    today = today or datetime.utcnow().date().isoformat()
+    try:
+        response = table.update_item(
+            Key={'id': user_id},
+            UpdateExpression="SET question_count = question_count + :one",
+            ConditionExpression=Attr('id').exists() & Attr('last_question_date').begins_with(today) & _under_limit(limits),
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='ALL_NEW',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+        return _allowed(response['Attributes'], limits)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # The old item on a failed condition comes back in the low-level wire format
+        item = e.response.get('Item')
+        user = {name: _deserializer.deserialize(value) for name, value in item.items()} if item else None
+
+    if not user:
+        return QuotaResult(False, error="User not found")
+
+    user_type = user.get('user_type', DEFAULT_TIER)
+    if not retry or str(user.get('last_question_date', '')).startswith(today):
+        return QuotaResult(
+            False,
+            limit=limit_for(user_type, limits),
+            user_type=user_type,
+            error=f"{user_type.capitalize()} user has reached maximum question limit",
+        )
+
+    try:
+        response = table.update_item(
+            Key={'id': user_id},
+            UpdateExpression="SET question_count = :one, last_question_date = :today",
+            ConditionExpression=Attr('id').exists() & (Attr('last_question_date').not_exists() | Attr('last_question_date').lt(today)),
+            ExpressionAttributeValues={':one': 1, ':today': today},
+            ReturnValues='ALL_NEW',
+        )
+        return _allowed(response['Attributes'], limits)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    # Another request reset the counter first, count against the new day
+    return consume_question(table, user_id, limits, today, retry=False)
@@ -0,0 +1,65 @@
+import importlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+_timings = OrderedDict()
+_timings_lock = threading.Lock()
+
+
+def record(name, seconds):
+    with _timings_lock:
+        _timings[name] = _timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def report():
+    with _timings_lock:
+        return [{"name": name, "seconds": round(seconds, 4)} for name, seconds in _timings.items()]
+
+
+def print_report(title="Startup report"):
+    print(f"{title}:")
+    for entry in report():
+        print(f"  {entry['seconds'] * 1000:9.1f} ms  {entry['name']}")
+
+
+class LazyModule:
+    # Stands in for a module and imports it (timed) on first attribute access
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = sys.modules.get(self._name)
+                if module is None:
+                    with timed(f"import {self._name}"):
+                        module = importlib.import_module(self._name)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._module or self._load()
+        return getattr(module, attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_module(name):
+    return LazyModule(name)
@@ -0,0 +1,275 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+_metrics = []
+_current = contextvars.ContextVar("trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            yield f"{self.name}{_labels(self.labelnames, labelvalues)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., +Inf count, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((labelvalues, list(values)) for labelvalues, values in self._series.items())
+        for labelvalues, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labelnames, labelvalues, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {values[-1]}"
+            yield f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}"
+
+
+def counter(name, help, labelnames=()):
+    metric = Counter(name, help, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, help, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def render():
+    # Prometheus text exposition format; metrics are per process
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = histogram("http_request_duration_seconds", "Request latency, including the whole body for streams.", ("method", "endpoint", "status"))
+STAGE_SECONDS = histogram("stage_duration_seconds", "Latency of one stage of a request.", ("stage",))
+STAGE_FAILURES = counter("stage_failures_total", "Stages that failed or timed out.", ("stage", "reason"))
+LLM_TOKENS = counter("llm_tokens_total", "LLM tokens used.", ("kind",))
+REQUEST_TOKENS = histogram("request_llm_tokens", "LLM tokens used per request.", ("endpoint",), buckets=TOKEN_BUCKETS)
+
+
+class Trace:
+    # Per-request state: trace ID, log sampling decision and what each stage cost
+    __slots__ = ("trace_id", "sampled", "started", "stages", "tokens", "_lock")
+
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.tokens = {}
+        self._lock = threading.Lock()
+
+    def add(self, mapping, key, amount):
+        with self._lock:
+            mapping[key] = mapping.get(key, 0) + amount
+
+
+def begin(trace_id=None):
+    # Reuses a well-formed incoming request ID so traces can be followed across services
+    if not trace_id or not re.fullmatch(r'[\w.-]{1,64}', trace_id):
+        trace_id = uuid.uuid4().hex
+    trace = Trace(trace_id, random.random() < LOG_SAMPLE_RATE)
+    _current.set(trace)
+    return trace
+
+
+def end():
+    _current.set(None)
+
+
+def current():
+    return _current.get()
+
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.observe(seconds, name)
+    trace = _current.get()
+    if trace is not None:
+        trace.add(trace.stages, name, seconds)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def stage_failed(name, reason):
+    STAGE_FAILURES.inc(name, reason)
+
+
+def add_tokens(kind, count):
+    if not count:
+        return
+    LLM_TOKENS.inc(kind, amount=count)
+    trace = _current.get()
+    if trace is not None:
+        trace.add(trace.tokens, kind, count)
+
+
+def finish_request(trace, method, endpoint, status):
+    seconds = time.perf_counter() - trace.started
+    REQUEST_SECONDS.observe(seconds, method, endpoint, str(status))
+    if trace.tokens:
+        REQUEST_TOKENS.observe(sum(trace.tokens.values()), endpoint)
+    get_logger("requests").log(
+        logging.ERROR if status >= 500 else logging.INFO,
+        "request",
+        extra={"fields": {
+            "method": method,
+            "endpoint": endpoint,
+            "status": status,
+            "duration_ms": round(seconds * 1000, 1),
+            "stages_ms": {name: round(value * 1000, 1) for name, value in trace.stages.items()},
+            "tokens": trace.tokens,
+        }},
+    )
+
+
+def instrument_boto_client(client):
+    # Times every call made through a botocore client as a "<service>.<Operation>" stage
+    service = client.meta.service_model.service_name
+
+    def call_started(context, **kwargs):
+        context['telemetry_started'] = time.perf_counter()
+
+    def call_finished(model, context, **kwargs):
+        started = context.get('telemetry_started')
+        if started is not None:
+            observe_stage(f"{service}.{model.name}", time.perf_counter() - started)
+
+    client.meta.events.register(f"before-call.{service}", call_started)
+    client.meta.events.register(f"after-call.{service}", call_finished)
+
+
+def run_in_context(executor, fn, *args):
+    # Submits fn to a pool thread with the caller's trace attached
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def run_with_trace(trace, fn, *args):
+    # Runs fn in a fresh context that carries only `trace`, for work that
+    # outlives the request; a copy of the request's context would carry
+    # Flask's app and request context with it
+    def run():
+        _current.set(trace)
+        return fn(*args)
+    return contextvars.Context().run(run)
+
+
+class _SampleFilter(logging.Filter):
+    # Warnings and errors are always kept; the rest only for sampled requests
+    def filter(self, record):
+        trace = _current.get()
+        record.trace_id = trace.trace_id if trace is not None else None
+        return record.levelno >= logging.WARNING or trace is None or trace.sampled
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "trace_id": getattr(record, "trace_id", None),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_logging_configured = False
+
+
+def configure_logging():
+    global _logging_configured
+    if _logging_configured:
+        return
+    _logging_configured = True
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(_SampleFilter())
+    logger = logging.getLogger("chatbot")
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(handler)
+    logger.propagate = False
+
+
+def get_logger(name):
+    return logging.getLogger(f"chatbot.{name}")
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+from bench import corpus, fakes
+from bench.run import BENCH_ENV, seed_users
+
+
+@pytest.fixture(scope="module")
+def chat_app(tmp_path_factory):
+    # The app against the benchmark's stand-ins for DynamoDB, OpenAI and gTTS,
+    # over a small synthetic corpus
+    cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    os.chdir(tmp_path_factory.mktemp("chat"))
+    os.environ.update(BENCH_ENV)
+    try:
+        corpus.build_corpus("data", 4)
+        fakes.install()
+        import app
+
+        app.setup_tables()
+        users = seed_users(app.users_table, 2)
+        yield app, users
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
+def login(chat_app, user):
+    app, _ = chat_app
+    client = app.app.test_client()
+    response = client.post("/login", data={"email": user["email"], "password": user["password"]})
+    assert response.status_code == 302
+    return client
+
+
+def test_chat_returns_answer_and_request_id(chat_app):
+    client = login(chat_app, chat_app[1][0])
+    response = client.post("/chat", json={"user_question": "How is formwork removed?"}, headers={"X-Request-ID": "chat-test-1"})
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"] == "chat-test-1"
+    assert response.get_json()["response_text"]
+
+
+def test_chat_stream_completes(chat_app):
+    client = login(chat_app, chat_app[1][1])
+    response = client.post("/chat/stream", json={"user_question": "When is rebar inspected?"})
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"]
+    body = response.get_data(as_text=True)
+    assert "event: answer" in body
+    assert "event: done" in body
+
+
+def test_chat_counts_llm_tokens(chat_app):
+    # Building chat engines must not drop the telemetry callback handler from
+    # the shared LLM, so every chat counts, not only the first
+    import telemetry
+
+    client = login(chat_app, chat_app[1][0])
+    for question in ("What is the curing time of a concrete slab?", "And for mortar?"):
+        before = telemetry.LLM_TOKENS.value("completion")
+        response = client.post("/chat", json={"user_question": question})
+        assert response.status_code == 200
+        assert telemetry.LLM_TOKENS.value("completion") > before
@@ -0,0 +1,35 @@
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+from embeddings import EmbeddingStore
+
+
+def test_stores_sharing_a_directory_keep_rows_aligned(tmp_path):
+    # Two writers (e.g. the server and an index refresh) appending in turns
+    first = EmbeddingStore(str(tmp_path))
+    second = EmbeddingStore(str(tmp_path))
+    first.put_many({"a": [1.0, 1.0], "b": [2.0, 2.0]})
+    second.put_many({"c": [3.0, 3.0]})
+    first.put_many({"d": [4.0, 4.0]})
+
+    for store in (first, second, EmbeddingStore(str(tmp_path))):
+        assert store.get_many(["a", "b", "c", "d"]) == {
+            "a": [1.0, 1.0], "b": [2.0, 2.0], "c": [3.0, 3.0], "d": [4.0, 4.0]}
+
+
+def test_write_cut_short_is_ignored(tmp_path):
+    store = EmbeddingStore(str(tmp_path))
+    store.put_many({"a": [1.0, 1.0]})
+    # A crash mid-append leaves half a row and part of a key line
+    with open(store.vectors_path, 'ab') as f:
+        f.write(b"\0" * 4)
+    with open(store.keys_path, 'ab') as f:
+        f.write(b'["b", ')
+
+    store = EmbeddingStore(str(tmp_path))
+    store.put_many({"c": [3.0, 3.0]})
+    assert EmbeddingStore(str(tmp_path)).get_many(["a", "b", "c"]) == {"a": [1.0, 1.0], "c": [3.0, 3.0]}
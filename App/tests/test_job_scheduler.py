@@ -0,0 +1,60 @@
+import os
+import sys
+import threading
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+from job_scheduler import JobScheduler
+
+
+def test_coalesced_job_started_after_its_work_finished():
+    # A job reserved onto an in-flight work takes no place in the queue; if
+    # that work finishes before the job is started, the job must not queue a
+    # new run past max_queued
+    scheduler = JobScheduler(workers=1, max_queued=1)
+    release = threading.Event()
+
+    def slow(emit):
+        release.wait()
+        return "answer"
+
+    first = scheduler.reserve("u1", 1, "same question")
+    scheduler.start(first, slow)
+    second = scheduler.reserve("u2", 1, "same question")
+    assert not second.slot
+
+    release.set()
+    assert scheduler.wait(first, 5)
+    other = scheduler.reserve("u3", 1)  # takes the only place in the queue
+
+    scheduler.start(second, lambda emit: "run again", on_done=lambda job, result: result.upper())
+    stats = scheduler.stats()
+    assert stats["queued"] + stats["reserved"] <= scheduler.max_queued
+    assert scheduler.wait(second, 0)
+    assert second.coalesced
+    assert second.result == "ANSWER"
+    scheduler.cancel(other)
+
+
+def test_identical_jobs_share_one_run():
+    scheduler = JobScheduler(workers=1)
+    release = threading.Event()
+    runs = []
+
+    def answer(emit):
+        runs.append(1)
+        release.wait()
+        return "answer"
+
+    jobs = []
+    for user_id in ("u1", "u2", "u3"):
+        job = scheduler.reserve(user_id, 1, "same question")
+        scheduler.start(job, answer)
+        jobs.append(job)
+    release.set()
+    for job in jobs:
+        assert scheduler.wait(job, 5)
+        assert job.result == "answer"
+    assert len(runs) == 1
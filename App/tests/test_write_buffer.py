@@ -0,0 +1,79 @@
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+from botocore.exceptions import ClientError
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+from write_buffer import WriteBehindBuffer
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "BatchWriteItem")
+
+
+class FakeTable:
+    # Rejects items with a "bad" attribute the way DynamoDB rejects an item
+    # over 400KB, failing the whole batch; `throttle` fails the next n writes
+    def __init__(self, name):
+        self.name = name
+        self.items = []
+        self.throttle = 0
+
+    def _check(self, item):
+        if self.throttle:
+            self.throttle -= 1
+            raise client_error("ProvisionedThroughputExceededException")
+        if "bad" in item:
+            raise client_error("ValidationException")
+
+    @contextmanager
+    def batch_writer(self, overwrite_by_pkeys=None):
+        batch = []
+        yield type("Writer", (), {"put_item": lambda _, Item: batch.append(Item)})()
+        for item in batch:
+            self._check(item)
+        self.items.extend(batch)
+
+    def put_item(self, Item):
+        self._check(Item)
+        self.items.append(Item)
+
+
+def buffer_with(table, *items):
+    buffer = WriteBehindBuffer({table.name: ["user_id", "timestamp"]})
+    buffer._pid = os.getpid()  # no background thread, the test flushes
+    for item in items:
+        buffer.put(table, item)
+    return buffer
+
+
+def test_rejected_item_is_dropped_and_the_rest_written():
+    table = FakeTable("ChatHistory")
+    good = [{"user_id": "u", "timestamp": str(i)} for i in range(3)]
+    bad = {"user_id": "u", "timestamp": "x", "bad": True}
+    buffer = buffer_with(table, good[0], bad, good[1], good[2])
+
+    buffer.flush()
+    assert table.items == good
+    assert buffer.pending() == 0
+    assert buffer.stats()["dropped"] == 1
+    assert buffer.stats()["written"] == 3
+
+
+def test_throttled_batch_is_queued_again():
+    table = FakeTable("ChatHistory")
+    items = [{"user_id": "u", "timestamp": str(i)} for i in range(3)]
+    buffer = buffer_with(table, *items)
+    table.throttle = 1
+
+    with pytest.raises(ClientError):
+        buffer.flush()
+    assert buffer.pending() == 3
+    buffer.flush()
+    assert table.items == items
+    assert buffer.stats()["dropped"] == 0
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from gtts import gTTS
+
+import telemetry
+
+audio_cache_dir = os.getenv("AUDIO_CACHE_DIR", "./audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+# Registering new text evicts at most this often, a full scan per answer would be wasteful
+AUDIO_EVICT_INTERVAL = float(os.getenv("AUDIO_EVICT_INTERVAL", 60))
+
+# Striped locks so the same text is only synthesised once at a time
+_locks = [threading.Lock() for _ in range(64)]
+_last_evict = 0.0
+_evict_lock = threading.Lock()
+
+
+def audio_key(text, lang='en'):
+    return hashlib.sha256(f"{lang}\0{text}".encode('utf-8')).hexdigest()
+
+
+def _paths(key):
+    return (
+        os.path.join(audio_cache_dir, key + ".mp3"),
+        os.path.join(audio_cache_dir, key + ".json"),
+    )
+
+
+def _lock_for(key):
+    return _locks[int(key[:8], 16) % len(_locks)]
+
+
+def register(text, lang='en'):
+    # Only the text is stored here, the audio is synthesised on first playback
+    key = audio_key(text, lang)
+    _, text_path = _paths(key)
+    try:
+        os.utime(text_path)
+        return key
+    except FileNotFoundError:
+        # New, or evicted since
+        pass
+    os.makedirs(audio_cache_dir, exist_ok=True)
+    tmp_path = f"{text_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"text": text, "lang": lang}, f)
+    os.replace(tmp_path, text_path)
+    # Texts whose audio is never played count against the budget too
+    _evict_periodically()
+    return key
+
+
+def get_audio_path(key):
+    audio_path, text_path = _paths(key)
+    try:
+        # mtime doubles as the last access time for LRU eviction
+        os.utime(audio_path)
+        return audio_path
+    except FileNotFoundError:
+        # Not synthesised yet, or evicted meanwhile
+        pass
+    if not os.path.exists(text_path):
+        return None
+
+    with _lock_for(key):
+        if not os.path.exists(audio_path):
+            try:
+                with open(text_path) as f:
+                    meta = json.load(f)
+            except FileNotFoundError:
+                return None
+            tmp_path = f"{audio_path}.{threading.get_ident()}.tmp"
+            with telemetry.stage("tts"):
+                gTTS(text=meta["text"], lang=meta["lang"]).save(tmp_path)
+            os.replace(tmp_path, audio_path)
+            evict()
+    return audio_path
+
+
+def _evict_periodically():
+    global _last_evict
+    with _evict_lock:
+        if time.monotonic() - _last_evict < AUDIO_EVICT_INTERVAL:
+            return
+        _last_evict = time.monotonic()
+    evict()
+
+
+def evict(max_bytes=AUDIO_CACHE_MAX_BYTES):
+    # Drop least recently used entries (audio and text together) until under budget
+    entries = {}
+    total = 0
+    for name in os.listdir(audio_cache_dir):
+        key, ext = os.path.splitext(name)
+        if ext not in (".mp3", ".json"):
+            continue
+        try:
+            stat = os.stat(os.path.join(audio_cache_dir, name))
+        except FileNotFoundError:
+            continue
+        last_used, size = entries.get(key, (0, 0))
+        entries[key] = (max(last_used, stat.st_mtime), size + stat.st_size)
+        total += stat.st_size
+
+    for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+        if total <= max_bytes:
+            break
+        for path in _paths(key):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
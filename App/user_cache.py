@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+import telemetry
+
+USER_CACHE_REQUESTS = telemetry.counter("user_cache_requests_total", "User record lookups by result.", ("result",))
+USER_CACHE_AGE = telemetry.histogram(
+    "user_cache_hit_age_seconds",
+    "Age of user records served from the cache, an upper bound on their staleness.",
+    buckets=(0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300),
+)
+
+
+class UserCache:
+    # Read-through cache of Users items by id, bounded by a TTL and LRU size.
+    # Writers in this process update it directly; other processes' writes show
+    # up once the TTL runs out.
+
+    def __init__(self, table, ttl=30, max_entries=10000):
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # user_id -> (item, loaded_at)
+        self._reads = {}  # user_id -> token of the table read that may fill the entry
+        self._lock = threading.Lock()
+
+    def get(self, user_id, fresh=False):
+        # fresh=True always reads the table, for checks that must not be stale
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if not fresh and entry is not None and now - entry[1] <= self.ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                USER_CACHE_REQUESTS.inc("hit")
+                USER_CACHE_AGE.observe(now - entry[1])
+                return dict(entry[0])
+            if fresh:
+                result = "bypass"
+            elif entry is None:
+                result = "miss"
+            else:
+                result = "expired"
+                self.expired += 1
+            self.misses += 1
+            # A write-through while the table is read takes the token away,
+            # so the (possibly older) item read doesn't overwrite it
+            token = self._reads[user_id] = object()
+        USER_CACHE_REQUESTS.inc(result)
+
+        try:
+            item = self.table.get_item(Key={'id': user_id}).get('Item')
+        except Exception:
+            with self._lock:
+                if self._reads.get(user_id) is token:
+                    del self._reads[user_id]
+            raise
+        with self._lock:
+            if self._reads.get(user_id) is token:
+                del self._reads[user_id]
+                if item is None:
+                    self._entries.pop(user_id, None)
+                else:
+                    self._store(item)
+        return dict(item) if item is not None else None
+
+    def _store(self, item):
+        self._entries[item['id']] = (dict(item), time.monotonic())
+        self._entries.move_to_end(item['id'])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, item):
+        # Write-through after the item was written to the table
+        with self._lock:
+            self._reads.pop(item['id'], None)
+            self._store(item)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._reads.pop(user_id, None)
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._reads.clear()
+            self._entries.clear()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            lookups = self.hits + self.misses
+            ages = [now - loaded_at for _, loaded_at in self._entries.values()]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "oldest_entry_seconds": round(max(ages), 1) if ages else None,
+            }
@@ -0,0 +1,143 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import telemetry
+
+log = telemetry.get_logger("webhooks")
+
+
+class WebhookQueue:
+    # Durable local queue of webhook events, the event ID de-duplicates retries
+
+    def __init__(self, path="./webhook_events.db"):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id TEXT PRIMARY KEY, type TEXT NOT NULL, payload TEXT NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                "received REAL NOT NULL, next_attempt REAL NOT NULL, last_error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS events_pending ON events (status, next_attempt)")
+
+    def _connection(self):
+        # A connection opened before fork (e.g. by a preloading master) must
+        # not be used in the child, so each process opens its own
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, event_id, event_type, payload):
+        # Returns False when the event was already received
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO events (id, type, payload, received, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                (event_id, event_type, json.dumps(payload), now, now),
+            )
+        return cursor.rowcount == 1
+
+    def due(self, limit=10):
+        # Pending events, and claimed ones whose claim ran out (the process
+        # handling them died)
+        rows = self._connection().execute(
+            "SELECT id, type, payload, attempts FROM events "
+            "WHERE status IN ('pending', 'processing') AND next_attempt <= ? ORDER BY received LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+        return [(event_id, event_type, json.loads(payload), attempts) for event_id, event_type, payload, attempts in rows]
+
+    def claim(self, event_id, lease=300):
+        # Every worker process polls the same table: only the one whose
+        # update matches gets to apply the event, for `lease` seconds
+        now = time.time()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                "UPDATE events SET status = 'processing', next_attempt = ? "
+                "WHERE id = ? AND status IN ('pending', 'processing') AND next_attempt <= ?",
+                (now + lease, event_id, now),
+            )
+        return cursor.rowcount == 1
+
+    def mark_done(self, event_id):
+        with self._connection() as conn:
+            conn.execute("UPDATE events SET status = 'done', last_error = NULL WHERE id = ?", (event_id,))
+
+    def mark_failed(self, event_id, error, retry_in=None):
+        # retry_in=None gives up on the event
+        with self._connection() as conn:
+            if retry_in is None:
+                conn.execute(
+                    "UPDATE events SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                    (error, event_id),
+                )
+            else:
+                conn.execute(
+                    "UPDATE events SET status = 'pending', attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE id = ?",
+                    (time.time() + retry_in, error, event_id),
+                )
+
+    def counts(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM events GROUP BY status").fetchall()
+        return dict(rows)
+
+
+class WebhookWorker:
+    # Applies queued events in a background thread, retrying with exponential backoff
+
+    def __init__(self, queue, handlers, poll_interval=5.0, max_attempts=8):
+        self.queue = queue
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        # Threads don't survive fork, so each worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="webhook-worker", daemon=True).start()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.process_due()
+            except Exception:
+                log.exception("Webhook worker error")
+
+    def process_due(self):
+        for event_id, event_type, payload, attempts in self.queue.due():
+            if not self.queue.claim(event_id):
+                # Taken by another process
+                continue
+            handler = self.handlers.get(event_type)
+            if handler is None:
+                self.queue.mark_done(event_id)
+                continue
+            try:
+                handler(payload)
+            except Exception as e:
+                retry_in = 2 ** attempts if attempts + 1 < self.max_attempts else None
+                self.queue.mark_failed(event_id, str(e), retry_in)
+                log.warning("Webhook event failed", extra={"fields": {"event_id": event_id, "attempt": attempts + 1, "error": str(e)}})
+            else:
+                self.queue.mark_done(event_id)
@@ -0,0 +1,186 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import telemetry
+
+log = telemetry.get_logger("write_buffer")
+
+# Errors a later attempt can get past; anything else (e.g. a ValidationException
+# for an item over 400KB) fails the same way every time
+RETRYABLE_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+    "ServiceUnavailable",
+}
+
+
+def retryable(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in RETRYABLE_ERRORS
+    return isinstance(error, BotoCoreError)
+
+
+class WriteBehindBuffer:
+    # Queues DynamoDB puts and writes them from a background thread with
+    # batch_writer, when a table has a full batch or every flush_interval.
+    # Puts are idempotent, so a batch that failed on throttling or a transient
+    # error is simply queued again; items DynamoDB rejects are logged and dropped.
+
+    def __init__(self, overwrite_keys, batch_size=25, flush_interval=1.0, max_pending=10000,
+                 max_backoff=30.0, drain_timeout=30.0, enabled=True):
+        self.overwrite_keys = overwrite_keys  # table name -> primary key attributes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self.drain_timeout = drain_timeout
+        self.enabled = enabled
+        self.written = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.sync_writes = 0
+        self._pending = {}  # table name -> (table, deque of items)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+
+    def ensure_started(self):
+        # Threads don't survive fork, so each worker process starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="write-buffer", daemon=True).start()
+            atexit.register(self.drain)
+
+    def put(self, table, item):
+        with self._lock:
+            full = not self.enabled or sum(len(items) for _, items in self._pending.values()) >= self.max_pending
+            if not full:
+                _, items = self._pending.setdefault(table.name, (table, deque()))
+                items.append(item)
+                batch_ready = len(items) >= self.batch_size
+        if full:
+            # Disabled, or DynamoDB has fallen too far behind: write on the
+            # request path rather than grow without bound
+            table.put_item(Item=item)
+            with self._lock:
+                self.sync_writes += 1
+            return
+        self.ensure_started()
+        if batch_ready:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return sum(len(items) for _, items in self._pending.values())
+
+    def _take(self):
+        with self._lock:
+            batches = []
+            for table, items in self._pending.values():
+                if items:
+                    batches.append((table, [items.popleft() for _ in range(min(self.batch_size, len(items)))]))
+            return batches
+
+    def _requeue(self, batches):
+        with self._lock:
+            for table, batch in batches:
+                self._pending[table.name][1].extendleft(reversed(batch))
+
+    def _drop(self, table, item, error):
+        key = {name: item.get(name) for name in self.overwrite_keys.get(table.name) or ()}
+        log.error("Write-behind item dropped", extra={"fields": {"table": table.name, "key": key, "error": str(error)}})
+        with self._lock:
+            self.dropped += 1
+
+    def flush(self):
+        # Writes everything pending; on a retryable failure the unwritten
+        # batches go back to the front of the queue and the error is raised
+        with self._flush_lock:
+            while True:
+                batches = self._take()
+                if not batches:
+                    return
+                for i, (table, batch) in enumerate(batches):
+                    written = len(batch)
+                    try:
+                        with table.batch_writer(overwrite_by_pkeys=self.overwrite_keys.get(table.name)) as writer:
+                            for item in batch:
+                                writer.put_item(Item=item)
+                    except Exception as e:
+                        if retryable(e):
+                            self._requeue(batches[i:])
+                            raise
+                        # One rejected item fails its whole request, so find
+                        # it by writing the items one at a time
+                        for j, item in enumerate(batch):
+                            try:
+                                table.put_item(Item=item)
+                            except Exception as e:
+                                if retryable(e):
+                                    self._requeue([(table, batch[j:])] + batches[i + 1:])
+                                    raise
+                                self._drop(table, item, e)
+                                written -= 1
+                    with self._lock:
+                        self.written += written
+
+    def _backoff(self, attempt):
+        return min(self.max_backoff, 0.5 * 2 ** attempt)
+
+    def _run(self):
+        attempt = 0
+        while True:
+            if attempt:
+                time.sleep(self._backoff(attempt))
+            else:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+            try:
+                self.flush()
+                attempt = 0
+            except Exception as e:
+                attempt += 1
+                with self._lock:
+                    self.failed_flushes += 1
+                log.warning("Write-behind flush failed", extra={"fields": {"attempt": attempt, "pending": self.pending(), "error": str(e)}})
+
+    def drain(self):
+        # Runs at exit: keeps retrying until everything is written or the timeout passes
+        deadline = time.monotonic() + self.drain_timeout
+        attempt = 0
+        while self.pending():
+            try:
+                self.flush()
+            except Exception as e:
+                attempt += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.error("Write-behind buffer not drained", extra={"fields": {"pending": self.pending(), "error": str(e)}})
+                    return
+                time.sleep(min(self._backoff(attempt), remaining))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "pending": {name: len(items) for name, (_, items) in self._pending.items()},
+                "written": self.written,
+                "failed_flushes": self.failed_flushes,
+                "dropped": self.dropped,
+                "sync_writes": self.sync_writes,
+                "batch_size": self.batch_size,
+                "flush_interval": self.flush_interval,
+                "max_pending": self.max_pending,
+            }